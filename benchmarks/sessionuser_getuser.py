@@ -0,0 +1,73 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+GetUser cache hit benchmark
+---------------------------
+Compares cache hits through the `getuser` event (`RootListener.LookupCache` raising
+`UserFound`) with the direct `Userroot.GetCachedUser` lookup. ::
+
+    python benchmarks/sessionuser_getuser.py [lookups]
+
+"""
+
+import sys
+import time
+
+from nive.definitions import Conf
+from nive.events import Events
+from nive.security import UserFound
+
+from nive_userdb.root import Userroot
+from nive_userdb.extensions.sessionuser import SessionUser, SessionUserCache, RootListener
+
+
+class App(object):
+    pass
+
+
+class Root(RootListener, Events):
+    # a userroot with the session user extension and no database
+    GetUser = Userroot.GetUser
+    GetCachedUser = Userroot.GetCachedUser
+
+    def __init__(self, app):
+        self.app = app
+        self.InitEvents()
+
+
+def event(root, ident):
+    # the previous GetUser hit path
+    try:
+        root.Signal("getuser", ident=ident, activeOnly=1)
+    except UserFound as user:
+        return user.user
+    return None
+
+
+def direct(root, ident):
+    return root.GetUser(ident)
+
+
+def measure(function, root, lookups):
+    start = time.perf_counter()
+    for i in range(lookups):
+        function(root, "user1")
+    return lookups / (time.perf_counter() - start)
+
+
+def main():
+    lookups = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    app = App()
+    app.usercache = SessionUserCache()
+    app.usercache.Add(SessionUser("user1", 1, Conf(name="user1", groups=()), Conf()), "user1")
+    root = Root(app)
+    assert event(root, "user1") is direct(root, "user1")
+    print("%10s %16s" % ("path", "lookups/s"))
+    for name, function in (("event", event), ("direct", direct)):
+        print("%10s %16.0f" % (name, measure(function, root, lookups)))
+
+
+if __name__ == "__main__":
+    main()
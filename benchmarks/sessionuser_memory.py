@@ -0,0 +1,86 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+Session user memory benchmark
+-----------------------------
+Measures the memory used per cached user in `SessionUserCache` for the compact
+`SessionUser` and for the previous representation with two locked `Conf` objects. ::
+
+    python benchmarks/sessionuser_memory.py [number of users ...]
+
+"""
+
+import sys
+import time
+import tracemalloc
+
+from nive.definitions import Conf
+
+from nive_userdb.extensions.sessionuser import SessionUser, SessionUserCache, GetSessionUserLayout
+
+
+DATAFIELDS = ("title", "name", "email", "surname", "lastname", "groups", "notify", "lastlogin")
+METAFIELDS = ("id", "pool_state")
+GROUPS = (("group:author",), ("group:editor",), ("group:author", "group:editor"), ())
+
+
+class ConfUser(object):
+    # session user as stored before the compact representation
+    def __init__(self, ident, id, data, meta):
+        self.id = id
+        self.identity = ident
+        self.data = data
+        self.meta = meta
+        self.lastlogin = data.get("lastlogin")
+        self.currentlogin = time.time()
+
+
+def values(i):
+    data = dict(title="user%d" % i, name="user%d" % i, email="user%d@example.com" % i,
+                surname="Surname", lastname="Lastname", groups=GROUPS[i % len(GROUPS)],
+                notify=True, lastlogin=time.time())
+    meta = dict(id=i, pool_state=1)
+    return data, meta
+
+
+def conf(i):
+    data, meta = values(i)
+    data = Conf(**data)
+    meta = Conf(**meta)
+    data.lock()
+    meta.lock()
+    ident = data.name
+    return ConfUser(ident, i, data, meta), ident
+
+
+def compact(i):
+    data, meta = values(i)
+    layout = GetSessionUserLayout(DATAFIELDS, METAFIELDS)
+    v = tuple([data[f] for f in DATAFIELDS] + [meta[f] for f in METAFIELDS])
+    ident = data["name"]
+    return SessionUser.FromValues(ident, i, layout, v, lastlogin=data["lastlogin"]), ident
+
+
+def measure(factory, count):
+    cache = SessionUserCache(expires=0, maxentries=0)
+    tracemalloc.start()
+    before = tracemalloc.get_traced_memory()[0]
+    for i in range(count):
+        user, ident = factory(i)
+        cache.Add(user, ident)
+    size = tracemalloc.get_traced_memory()[0] - before
+    tracemalloc.stop()
+    return size / count
+
+
+def main():
+    counts = [int(c) for c in sys.argv[1:]] or [100000, 1000000]
+    print("%10s %16s %16s" % ("users", "conf bytes/user", "compact bytes/user"))
+    for count in counts:
+        print("%10d %16.0f %16.0f" % (count, measure(conf, count), measure(compact, count)))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,65 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+Session user cache thread benchmark
+-----------------------------------
+Measures Get/Add throughput of `SessionUserCache` with a growing number of threads.
+Run on a free-threaded python build (e.g. python3.13t) to see the effect of lock striping
+without the GIL. ::
+
+    python benchmarks/sessionuser_threads.py [operations per run] [stripes]
+
+"""
+
+import sys
+import threading
+import time
+
+from nive.definitions import Conf
+
+from nive_userdb.extensions.sessionuser import SessionUser, SessionUserCache
+
+
+USERS = 20000
+THREADCOUNTS = (1, 2, 4, 8, 16, 32, 64)
+
+
+def run(cache, threads, operations):
+    # each thread performs an equal share of operations. all threads start together.
+    count = operations // threads
+    barrier = threading.Barrier(threads + 1)
+
+    def worker(n):
+        i = n
+        barrier.wait()
+        for x in range(count):
+            ident = "user%d" % (i % USERS)
+            if cache.Get(ident) is None:
+                cache.Add(SessionUser(ident, i, Conf(), Conf()), ident)
+            i += 7919
+
+    workers = [threading.Thread(target=worker, args=(n,)) for n in range(threads)]
+    for w in workers:
+        w.start()
+    barrier.wait()
+    start = time.perf_counter()
+    for w in workers:
+        w.join()
+    return count * threads / (time.perf_counter() - start)
+
+
+def main():
+    operations = int(sys.argv[1]) if len(sys.argv) > 1 else 500000
+    stripes = int(sys.argv[2]) if len(sys.argv) > 2 else None
+    gil = getattr(sys, "_is_gil_enabled", lambda: True)()
+    print("python %s, GIL %s" % (sys.version.split()[0], "enabled" if gil else "disabled"))
+    print("%8s %16s" % ("threads", "ops/s"))
+    for threads in THREADCOUNTS:
+        cache = SessionUserCache(expires=0, maxentries=USERS, stripes=stripes)
+        print("%8d %16.0f" % (threads, run(cache, threads, operations)))
+
+
+if __name__ == "__main__":
+    main()
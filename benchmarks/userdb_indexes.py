@@ -0,0 +1,97 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+User lookup index benchmark
+---------------------------
+Creates a temporary sqlite user database, inserts users and reset tokens with plain sql and
+measures `LookupUser` latency for existing and unknown names and `GetUserForToken` latency
+before and after running
+`nive_userdb.tools.dbIndexUpdater`. ::
+
+    python benchmarks/userdb_indexes.py [users] [lookups]
+
+"""
+
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+
+from nive.definitions import AppConf, DatabaseConf, MetaTbl
+from nive.portal import Portal
+
+from nive_userdb.app import UserDB
+from nive_userdb.tokens import TokenTbl, HashToken
+
+
+def app_db(path):
+    appconf = AppConf("nive_userdb.app")
+    app = UserDB()
+    app.Register(appconf)
+    app.Register(DatabaseConf(dbName=os.path.join(path, "users.db"), fileRoot=path, context="Sqlite3"))
+    p = Portal()
+    p.Register(app, "userdb")
+    app.Startup(None)
+    app.GetTool("nive.tools.dbStructureUpdater")()
+    return app
+
+
+def fill(app, count):
+    db = app.db
+    root = app.root
+    conn = db.connection.cursor().connection
+    batch = 50000
+    for start in range(1, count+1, batch):
+        ids = range(start, min(start+batch, count+1))
+        conn.executemany("INSERT INTO users (id, name, email, namenorm, emailnorm) VALUES (?,?,?,?,?)",
+                         [(i, "user%d" % i, "user%d@example.com" % i, "user%d" % i, "user%d@example.com" % i) for i in ids])
+        conn.executemany("INSERT INTO %s (tokenkey, id, purpose, expires) VALUES (?,?,?,?)" % TokenTbl,
+                         [(HashToken("token%d" % i), i, "reset", 0) for i in ids])
+        conn.executemany("INSERT INTO %s (id, pool_type, pool_dataref, pool_datatbl, pool_state, pool_unitref) "
+                         "VALUES (?,?,?,?,?,?)" % MetaTbl,
+                         [(i, "user", i, "users", 1, root.id) for i in ids])
+    conn.commit()
+
+
+def measure(app, count, lookups):
+    root = app.root
+    names = ["user%d" % random.randint(1, count) for i in range(lookups)]
+    start = time.perf_counter()
+    for name in names:
+        assert root.LookupUser(name=name) is not None
+    name = (time.perf_counter() - start) / lookups
+    start = time.perf_counter()
+    for name_ in names:
+        assert root.LookupUser(name="unknown"+name_) is None
+    miss = (time.perf_counter() - start) / lookups
+    start = time.perf_counter()
+    for name_ in names:
+        assert root.GetUserForToken("token"+name_[4:], purpose="reset") is not None
+    token = (time.perf_counter() - start) / lookups
+    return name, miss, token
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000000
+    lookups = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+    path = tempfile.mkdtemp()
+    try:
+        app = app_db(path)
+        fill(app, count)
+        print("%10s %20s %20s %20s" % ("indexes", "LookupUser ms", "LookupUser miss ms", "GetUserForToken ms"))
+        name, miss, token = measure(app, count, lookups)
+        print("%10s %20.3f %20.3f %20.3f" % ("none", name*1000, miss*1000, token*1000))
+        app.GetTool("nive_userdb.tools.dbIndexUpdater")()
+        name, miss, token = measure(app, count, lookups*50)
+        print("%10s %20.3f %20.3f %20.3f" % ("created", name*1000, miss*1000, token*1000))
+        app.Close()
+    finally:
+        shutil.rmtree(path)
+
+
+if __name__ == "__main__":
+    main()
@@ -28,6 +28,7 @@ from nive.components.reform.schema import Email
 from nive.components.reform.schema import Literal, Length
 
 from nive_userdb.i18n import _
+from nive_userdb.userloader import GetUserLoader
 
 #@nive_module
 configuration = AppConf(
@@ -38,6 +39,8 @@ configuration = AppConf(
     identityFallbackAlternative = True, # tries both: name and email as identity fields
     authMaxAge = 0, # e.g. 60*60*24*7 one week
     maintenance = False, # if true login and reset password disabled
+    # token lifetime in seconds by purpose. 0 = never expires
+    tokenExpires = {"activate": 60*60*24*30, "reset": 60*60*24, "verifymail": 60*60*24*7},
 
     # signup settings
     settings = Conf(
@@ -78,6 +81,10 @@ configuration.modules = [
     # tools
     "nive.components.reform.reformed",
     "nive.tools.dbStructureUpdater",
+    "nive_userdb.tools.dbIndexUpdater",
+    "nive_userdb.tools.normalizeIdentities",
+    "nive_userdb.tools.purgeTokens",
+    "nive_userdb.tools.syncUserGroups",
     "nive.extensions.persistence.dbPersistenceConfiguration",
     # system administration
     "nive.components.adminview"
@@ -117,12 +124,14 @@ class UserDB(Application):
     def Principals(self, userid, request=None, context=None):
         """
         returns the list of groups assigned to the user 
+
+        Principals are computed once per user and context for the request. 
         """
         if request is not None:
             try:
                 user = request.environ["authenticated_user"]
             except (AttributeError, KeyError):
-                user = self.root.GetUser(userid)
+                user = GetUserLoader(request, self).Get(userid)
                 if not hasattr(request, "environ"):
                     request.environ = dict()
                 request.environ["authenticated_user"] = user
@@ -136,18 +145,38 @@ class UserDB(Application):
         if user is None:
             return None
 
-        # users groups or empty list
-        groups = user.groups or ()
-
         # lookup context for local roles
         if context is None and hasattr(request, "context"):
             context = request.context
-        if context and ILocalGroups.providedBy(context):
+        if not context or not ILocalGroups.providedBy(context):
+            context = None
+
+        memo = None
+        if request is not None:
+            memo = GetUserLoader(request, self).principals
+            key = (str(userid), id(user), id(context))
+            try:
+                return memo[key][1]
+            except KeyError:
+                pass
+
+        # users groups or empty list
+        groups = user.groups or ()
+        if context is not None:
             local = context.GetLocalGroups(userid, user=user)
-            if not groups:
-                return local
-            return tuple(list(groups)+list(local))
-        return groups
+            if groups:
+                # user and session user objects keep the global groups as frozenset
+                groupset = getattr(user, "groupset", None)
+                if groupset is None:
+                    groupset = frozenset(groups)
+                local = tuple(groups) + tuple([g for g in local if not g in groupset])
+            principals = local
+        else:
+            principals = groups
+        if memo is not None:
+            # the context and user are stored to keep the ids in the key valid
+            memo[key] = ((context, user), principals)
+        return principals
 
 
 
@@ -166,6 +195,18 @@ def IsReservedUserName(name):
     return False
 
 
+# normalized shadow columns for case insensitive name and email lookups
+NormalizedFields = {"name": "namenorm", "email": "emailnorm"}
+
+def NormalizeIdentity(value):
+    """
+    Returns the normalized (stripped, lower case) value used for case insensitive lookups
+    """
+    if not value:
+        return ""
+    return str(value).strip().lower()
+
+
 def UsernameValidator(node, value):
     """
     Validator which succeeds if the username does not exist.
@@ -181,15 +222,14 @@ def UsernameValidator(node, value):
         root = c.root
     else:
         root = c
-    u = root.search.Select(pool_type="user", parameter={"name": value}, fields=["id","name","email"], max=2, operators={"name":"="})
-    if not u:
-        u = root.search.Select(pool_type="user", parameter={"email": value}, fields=["id","name","email"], max=2, operators={"email":"="})
-    if not u and root.identityField not in ("name","email"):
-        u = root.search.Select(pool_type="user", parameter={root.identityField: value}, fields=["id","name","email"], max=2, operators={"email":"="})
+    fields = ["name", "email"]
+    if root.identityField not in fields:
+        fields.append(root.identityField)
+    u = root.FindUserIDs(value, fields)
     if u:
         # check if its the current user
         ctx = node.widget.form.context
-        if len(u)==1 and ctx.id == u[0][0]:
+        if len(u)==1 and ctx.id == u[0]:
             return
         err = _("Username '${name}' already in use. Please choose a different name.", mapping={'name':value})
         raise Invalid(node, err)
@@ -210,13 +250,11 @@ def EmailValidator(node, value):
         root = c.root
     else:
         root = c
-    u = root.search.Select(pool_type="user", parameter={"email": value}, fields=["id","name","email"], max=2, operators={"email":"="})
-    if not u:
-        u = root.search.Select(pool_type="user", parameter={"name": value}, fields=["id","name","email"], max=2, operators={"name":"="})
+    u = root.FindUserIDs(value, ("email", "name"))
     if u:
         # check if its the current user
         ctx = node.widget.form.context
-        if len(u)==1 and ctx.id == u[0][0]:
+        if len(u)==1 and ctx.id == u[0]:
             return
         err = _("Email '${name}' already in use. Please choose a different email.", mapping={'name':value})
         raise Invalid(node, err)
@@ -0,0 +1,22 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+
+def AddExtension(confs, extension):
+    """
+    Adds the extension class reference to the `extensions` of each configuration if not 
+    already set. Used by modules to extend the root and user objects.
+    """
+    for c in confs:
+        e = c.extensions
+        if e == None:
+            e = []
+        elif extension in e:
+            continue
+        if isinstance(e, tuple):
+            e = list(e)
+        e.append(extension)
+        c.unlock()
+        c.extensions = tuple(e)
+        c.lock()
@@ -0,0 +1,259 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+import logging
+import sys
+import threading
+
+from nive.definitions import ModuleConf, Conf
+
+from nive_userdb.app import NormalizeIdentity
+from nive_userdb.extensions import AddExtension
+
+
+"""
+Identity index
+--------------
+In memory index of user names, emails and identities. Resolves user ids without
+database queries in `LookupUser`, `AddUser` and the name and email validators.
+
+The index is optional. To enable it add the module to the applications modules ::
+
+    configuration.modules.append("nive_userdb.extensions.identityindex")
+
+Setup:
+- adds IdentityIndex object to userdb.app as userdb.identityindex
+- loads all users with a single query on application startup (run event)
+- listens to root *afterAdd* events
+- listens to user *committed* and *delete* events
+
+Names and emails are compared case insensitive, identities exactly. The index is only updated by changes made in the
+current process. If multiple processes change users call `Rebuild()` periodically or
+do not use the index.
+"""
+
+
+class IdentityIndex(object):
+    """
+    Maps normalized user names and emails and the user identities to user ids. The index
+    keys are `name`, `email` and `ident` for the identity field.
+
+    Each key is indexed in a dictionary `value -> id`. If more than one user shares a value
+    the ids are stored as tuple. The user state and indexed values are stored once per user
+    to support activeOnly lookups and updates.
+
+    The index is `ready` after it has been built.
+    """
+
+    def __init__(self, identityField="name", metafields=()):
+        self.identityField = identityField
+        # (index key, field, normalized). identities are compared exactly.
+        keys = [("name", "name", True), ("email", "email", True)]
+        if identityField:
+            keys.append(("ident", identityField, False))
+        self.keys = tuple(k[0] for k in keys)
+        self.fields = tuple(k[1] for k in keys)
+        self.normalized = dict((k[0], k[2]) for k in keys)
+        self.metafields = frozenset(metafields)
+        self.ready = False
+        self._Clear()
+        self._lock = threading.RLock()
+
+    def Build(self, records):
+        """
+        Replaces the index contents. `records` are dictionaries containing id, pool_state
+        and the indexed fields.
+        """
+        with self._lock:
+            self._Clear()
+            for record in records:
+                self._Add(record["id"], [record.get(f) for f in self.fields], record.get("pool_state"))
+            self.ready = True
+
+    def Update(self, id, values, state):
+        """
+        Adds or updates a user. `values` is a dictionary containing the indexed fields.
+        """
+        with self._lock:
+            self._Remove(id)
+            self._Add(id, [values.get(f) for f in self.fields], state)
+
+    def UpdateUser(self, user):
+        """
+        Adds or updates the user object.
+        """
+        values = {}
+        for f in self.fields:
+            if f in self.metafields:
+                values[f] = user.meta.get(f)
+            else:
+                values[f] = user.data.get(f)
+        self.Update(user.id, values, user.meta.get("pool_state"))
+
+    def Remove(self, id):
+        with self._lock:
+            self._Remove(id)
+
+    def Get(self, key, value, activeOnly=0):
+        """
+        Returns the ids of users with the index `key` = `value` as tuple.
+        """
+        ids = self._keys[key].get(self._Normalize(value, self.normalized[key]))
+        if ids is None:
+            return ()
+        if not isinstance(ids, tuple):
+            ids = (ids,)
+        if activeOnly:
+            users = self._users
+            ids = tuple(id for id in ids if id in users and users[id][0])
+        return ids
+
+    def Supports(self, key):
+        """
+        True if the index key exists and the index is ready
+        """
+        return self.ready and key in self._keys
+
+    def Rebuild(self, app):
+        """
+        Reloads all users from the database.
+        """
+        LoadIdentityIndex(app, self)
+
+    def MemoryUsage(self):
+        """
+        Returns the estimated memory usage of the index in bytes.
+        """
+        with self._lock:
+            size = sys.getsizeof(self._users)
+            for id, (state, values) in self._users.items():
+                size += sys.getsizeof(values)
+            for keys in self._keys.values():
+                size += sys.getsizeof(keys)
+                for key, ids in keys.items():
+                    size += sys.getsizeof(key)
+                    if isinstance(ids, tuple):
+                        size += sys.getsizeof(ids)
+            return size
+
+    def __len__(self):
+        return len(self._users)
+
+    def _Clear(self):
+        # index key -> {normalized value -> id or tuple of ids}
+        self._keys = dict((k, {}) for k in self.keys)
+        # id -> (state, normalized values)
+        self._users = {}
+
+    def _Add(self, id, values, state):
+        values = tuple(self._Normalize(v, self.normalized[k]) for v, k in zip(values, self.keys))
+        self._users[id] = (1 if state else 0, values)
+        for name, key in zip(self.keys, values):
+            if not key:
+                continue
+            keys = self._keys[name]
+            ids = keys.get(key)
+            if ids is None:
+                keys[key] = id
+            elif isinstance(ids, tuple):
+                keys[key] = ids + (id,)
+            elif ids != id:
+                keys[key] = (ids, id)
+
+    def _Remove(self, id):
+        user = self._users.pop(id, None)
+        if user is None:
+            return
+        for name, key in zip(self.keys, user[1]):
+            if not key:
+                continue
+            keys = self._keys[name]
+            ids = keys.get(key)
+            if ids == id:
+                del keys[key]
+            elif isinstance(ids, tuple):
+                ids = tuple(i for i in ids if i != id)
+                keys[key] = ids[0] if len(ids)==1 else ids
+
+    def _Normalize(self, value, normalize=True):
+        if not normalize:
+            return value or None
+        return NormalizeIdentity(value) or None
+
+
+class RootListener(object):
+
+    def Init(self):
+        self.ListenEvent("afterAdd", self.IndexUser)
+
+    def IndexUser(self, obj=None, **kw):
+        index = getattr(self.app, "identityindex", None)
+        if index is None or obj is None or obj.configuration.id != "user":
+            return
+        index.UpdateUser(obj)
+
+
+class UserListener(object):
+
+    def Init(self):
+        self.ListenEvent("committed", self.UpdateIndex)
+        self.ListenEvent("delete", self.RemoveFromIndex)
+
+    def UpdateIndex(self, **kw):
+        index = getattr(self.app, "identityindex", None)
+        if index is not None:
+            index.UpdateUser(self)
+
+    def RemoveFromIndex(self, **kw):
+        index = getattr(self.app, "identityindex", None)
+        if index is not None:
+            index.Remove(self.id)
+
+
+def LoadIdentityIndex(app, index=None):
+    """
+    Loads all users with a single query and builds the index.
+    """
+    root = app.root
+    if index is None:
+        identityField = root.identityField
+        metafields = [f for f in ("name", "email", identityField) if app.configurationQuery.GetMetaFld(f)]
+        index = IdentityIndex(identityField, metafields)
+    fields = ["id", "pool_state"]
+    for f in index.fields:
+        if f not in fields:
+            fields.append(f)
+    records = root.search.SelectDict(pool_type="user", fields=fields)
+    index.Build(records)
+    return index
+
+
+# identity index module definition
+
+def SetupIndex(app, pyramidConfig):
+    # get all roots and user and add Listeners
+    rootextension = "nive_userdb.extensions.identityindex.RootListener"
+    AddExtension(app.configurationQuery.GetAllRootConfs(), rootextension)
+    userextension = "nive_userdb.extensions.identityindex.UserListener"
+    AddExtension([app.configurationQuery.GetObjectConf("user",skipRoot=True)], userextension)
+    # the index is loaded on startup when the database is available
+    app.identityindex = None
+    app.RemoveListener("run", BuildIndex)
+    app.ListenEvent("run", BuildIndex)
+
+
+def BuildIndex(app):
+    try:
+        app.identityindex = LoadIdentityIndex(app)
+    except Exception as e:
+        # lookups fall back to database queries
+        app.identityindex = None
+        logging.getLogger("nive_userdb").warning("User identity index not loaded: %s", str(e))
+
+
+configuration = ModuleConf(
+    id = "identityindex",
+    name = "User identity index",
+    events = (Conf(event="startRegistration", callback=SetupIndex),),
+)
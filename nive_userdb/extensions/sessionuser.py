@@ -2,13 +2,24 @@
 # Released under GPL3. See license.txt
 #
 
-import _thread
+import logging
+import os
+import pickle
+import sqlite3
+import threading
 import time
+import weakref
+from collections import OrderedDict, deque
+from operator import itemgetter
 
 from nive.definitions import Interface, implementer
-from nive.definitions import ModuleConf, Conf
+from nive.definitions import ModuleConf, Conf, IModuleConf
+from nive.definitions import ConfigurationError, MetaTbl
+from nive.helper import GetClassRef
 from nive.security import UserFound
 
+from nive_userdb.extensions import AddExtension
+
 
 """
 Session user cache
@@ -18,9 +29,21 @@ as request.environ["authenticated_user"]
 
 Setup:
 - adds SessionUserCache object to usedb.app as userdb.usercache
-- 
-- listens to root *getuser* events
-- listens to user *login*, *logout*, *commit*, *delete*
+- compiles the session user field list `app.configuration.sessionuser` as userdb.sessionuserplan
+- the cache size, expiry time and number of lock stripes can be set in the module 
+  configuration as `maxentries`, `expires` and `stripes`
+- expired users are removed incrementally. `purgeInterval` starts a background purge thread
+- the cache backend can be replaced by setting `backend` in the module configuration. 
+  `SqliteSessionUserCache` shares cached users between all processes on a host
+- caches identities not found in the database for a short time as userdb.usermisses
+- saves the cache on shutdown and restores it on startup if `snapshot` is set. `warmup`
+  preloads the most recently active users on startup
+- concurrent lookups of the same uncached identity share a single database load in 
+  `Userroot.GetUser()` (userdb.userloads)
+- listens to root *getuser*, *loaduser*, *usernotfound* and *afterAdd* events
+- listens to user *login*, *logout*, *commit*, *committed*, *delete*, *activate*. Commits 
+  remove cached users if session user fields are changed and add the stored values after the
+  database commit succeeded
 
 """
 
@@ -30,105 +53,469 @@ class ISessionUser(Interface):
 
 class SessionUserCache(object):
     """
-    User caching support. Caches users including data as attributes. 
+    User caching support. Caches session users in a bounded LRU list. Entries are checked
+    for expiry on access and the least recently used entry is removed if the cache is full.
+
+    The cache is split into `stripes` independent LRU lists each with its own lock. Cache keys
+    are distributed by hash, so concurrent threads usually do not block each other. LRU order
+    and `maxentries` are applied per stripe.
+
+    Expired entries are removed incrementally. Each stripe keeps a queue of entries in the
+    order they were added, which is also the order they expire. `Add` removes up to
+    `purgeSteps` expired entries and `Purge` removes all expired entries from the head
+    of the queues without scanning the cache. If `purgeInterval` is set a daemon thread
+    calls `Purge` every `purgeInterval` seconds until `Close` is called.
     
     Options: ::
 
         expires = objs are reloaded or purged after this many seconds. 0 = never expires 
+        maxentries = maximum number of cached users. 0 = unlimited
+        stripes = number of independently locked cache partitions
+        purgeInterval = seconds between background purge runs. 0 = no background thread
 
     """
     expires = 20*60 
+    maxentries = 10000
+    stripes = 16
+    purgeInterval = 0
+    # number of expired entries removed on each Add
+    purgeSteps = 4
 
-    def __init__(self, expires=None):
+    def __init__(self, expires=None, maxentries=None, stripes=None, purgeInterval=None, **kw):
         if expires != None:
             self.expires = expires
+        if maxentries != None:
+            self.maxentries = maxentries
+        if stripes:
+            self.stripes = stripes
+        if purgeInterval != None:
+            self.purgeInterval = purgeInterval
+        self._stripes = tuple(_CacheStripe() for i in range(self.stripes))
+        self._purger = None
+        if self.purgeInterval:
+            self._purger = _Purger(self, self.purgeInterval)
+
+    @property
+    def evicted(self):
+        """
+        Total number of entries removed because they expired.
+        """
+        return sum(stripe.evicted for stripe in self._stripes)
 
     def Add(self, obj, id):
         """
+        Adds or replaces the cache entry for `id`. Removes the least recently used
+        entries if `maxentries` is exceeded.
         """
-        lock = None
-        try:
-            lock = _thread.allocate_lock()
-            lock.acquire(1)
-            setattr(self, self._Cachename(id), (obj, time.time()))
-            if lock.locked():
-                lock.release()
-        except Exception as e:
-            if lock and lock.locked():
-                lock.release()
+        key = self._Cachename(id)
+        stripe = self._Stripe(key)
+        limit = self._StripeLimit()
+        tt = time.time()
+        with stripe.lock:
+            entries = stripe.entries
+            entries[key] = (obj, tt)
+            entries.move_to_end(key)
+            stripe.queue.append((tt, key))
+            if limit:
+                while len(entries) > limit:
+                    entries.popitem(last=False)
+            if self.expires:
+                stripe.Expire(tt-self.expires, self.purgeSteps)
+            stripe.Compact()
 
     def Get(self, id):
         """
+        Returns the cached object or None. Expired entries are removed.
         """
-        n = self._Cachename(id)
-        lock = None
-        try:
-            lock = _thread.allocate_lock()
-            lock.acquire(1)
-            if hasattr(self, n):
-                o = getattr(self, n)
-                if lock.locked():
-                    lock.release()
-                return o[0]
-        except:
-            if lock and lock.locked():
-                lock.release()
-        return None
+        key = self._Cachename(id)
+        stripe = self._Stripe(key)
+        with stripe.lock:
+            entry = stripe.entries.get(key)
+            if entry is None:
+                return None
+            if self.expires and entry[1]+self.expires < time.time():
+                del stripe.entries[key]
+                stripe.evicted += 1
+                return None
+            stripe.entries.move_to_end(key)
+            return entry[0]
 
     def GetAll(self):
         """
+        Returns all cached and not expired objects as list.
         """
-        objs = []
-        lock = None
-        try:
-            lock = _thread.allocate_lock()
-            lock.acquire(1)
-            for v in list(self.__dict__.keys()):
-                if v[:5] == "__c__":
-                    objs.append(getattr(self, v)[0])
-            if lock.locked():
-                lock.release()
-        except:
-            if lock and lock.locked():
-                lock.release()
-        return objs
+        entries = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                entries.extend(stripe.entries.values())
+        if not self.expires:
+            return [e[0] for e in entries]
+        tt = time.time()
+        return [e[0] for e in entries if e[1]+self.expires >= tt]
 
     def Invalidate(self, id):
         """
+        Removes the cache entry for `id`.
         """
-        lock = None
-        try:
-            lock = _thread.allocate_lock()
-            lock.acquire(1)
-            try:
-                delattr(self, self._Cachename(id))
-            except:
-                pass
-            if lock.locked():
-                lock.release()
-        except:
-            if lock and lock.locked():
-                lock.release()
+        key = self._Cachename(id)
+        stripe = self._Stripe(key)
+        with stripe.lock:
+            stripe.entries.pop(key, None)
 
     def Purge(self):
         """
+        Removes all entries older than `expires` seconds. Returns the number of removed entries.
+        Entries never expire if `expires` is 0.
+        """
+        if not self.expires:
+            return 0
+        cutoff = time.time()-self.expires
+        count = 0
+        for stripe in self._stripes:
+            with stripe.lock:
+                count += stripe.Expire(cutoff)
+        return count
+
+    def Close(self):
+        """
+        Stops the background purge thread.
+        """
+        if self._purger is not None:
+            self._purger.Stop()
+            self._purger = None
+
+    def Dump(self):
+        """
+        Returns all not expired entries as list of (key, obj, time added) tuples. Used to
+        save the cache contents on shutdown.
+        """
+        entries = []
+        for stripe in self._stripes:
+            with stripe.lock:
+                entries.extend((k, e[0], e[1]) for k, e in stripe.entries.items())
+        if not self.expires:
+            return entries
+        cutoff = time.time()-self.expires
+        return [e for e in entries if e[2] >= cutoff]
+
+    def Load(self, entries):
+        """
+        Adds (key, obj, time added) tuples as returned by `Dump()`. Expired entries are skipped,
+        existing entries are not replaced. Returns the number of added entries.
+        """
+        cutoff = time.time()-self.expires if self.expires else None
+        limit = self._StripeLimit()
+        count = 0
+        # oldest first to keep the expiry queues ordered
+        for key, obj, added in sorted(entries, key=lambda e: e[2]):
+            if cutoff is not None and added < cutoff:
+                continue
+            stripe = self._Stripe(key)
+            with stripe.lock:
+                if key in stripe.entries or (limit and len(stripe.entries) >= limit):
+                    continue
+                stripe.entries[key] = (obj, added)
+                stripe.queue.append((added, key))
+            count += 1
+        return count
+
+    def _Cachename(self, id):
+        return str(id)
+
+    def _Stripe(self, key):
+        return self._stripes[hash(key) % len(self._stripes)]
+
+    def _StripeLimit(self):
+        if not self.maxentries:
+            return 0
+        # round up. the total number of entries may slightly exceed maxentries.
+        return -(-self.maxentries // len(self._stripes))
+
+
+class _CacheStripe(object):
+    """
+    Cache partition: LRU ordered entries, the expiry queue and the lock guarding them.
+    """
+    __slots__ = ("entries", "queue", "evicted", "lock")
+
+    def __init__(self):
+        # cache key -> (obj, time added). ordered by last access.
+        self.entries = OrderedDict()
+        # (time added, cache key) ordered by time added. contains stale records for replaced,
+        # invalidated or evicted entries. these are skipped.
+        self.queue = deque()
+        self.evicted = 0
+        self.lock = threading.Lock()
+
+    def Expire(self, cutoff, steps=None):
+        """
+        Removes entries added before `cutoff` from the head of the queue. Processes at
+        most `steps` queue records. Must be called with the lock held.
         """
-        lock = None
+        queue = self.queue
+        entries = self.entries
+        count = 0
+        while queue and queue[0][0] < cutoff:
+            if steps is not None:
+                if not steps:
+                    break
+                steps -= 1
+            added, key = queue.popleft()
+            entry = entries.get(key)
+            if entry is not None and entry[1] == added:
+                del entries[key]
+                count += 1
+        self.evicted += count
+        return count
+
+    def Compact(self):
+        """
+        Rebuilds the queue if stale records outnumber live entries. Must be called with the
+        lock held.
+        """
+        if len(self.queue) > 2*len(self.entries)+64:
+            self.queue = deque(sorted((e[1], k) for k, e in self.entries.items()))
+
+
+class _Purger(object):
+    """
+    Daemon thread calling `cache.Purge()` periodically. Only a weak reference to the cache
+    is kept, the thread ends if the cache is stopped or garbage collected.
+    """
+
+    def __init__(self, cache, interval):
+        self.interval = interval
+        self._stop = threading.Event()
+        ref = weakref.ref(cache)
+        stop = self._stop
+        def run():
+            while not stop.wait(interval):
+                cache = ref()
+                if cache is None:
+                    return
+                cache.Purge()
+                del cache
+        self.thread = threading.Thread(target=run, name="SessionUserCache purge")
+        self.thread.daemon = True
+        self.thread.start()
+
+    def Stop(self):
+        self._stop.set()
+
+
+class SqliteSessionUserCache(object):
+    """
+    Session user cache stored in a local sqlite file. All processes using the same file share
+    cached users. Invalidating a user removes the entry for all processes.
+
+    Users are stored pickled. The cache file must not be writable by others than the application.
+    
+    Options: ::
+
+        path = the cache file. required.
+        expires = objs are reloaded or purged after this many seconds. 0 = never expires 
+        maxentries = maximum number of cached users. 0 = unlimited
+
+    """
+    expires = 20*60 
+    maxentries = 10000
+    # check maxentries every n added entries
+    checkInterval = 100
+    timeout = 5.0
+
+    def __init__(self, path=None, expires=None, maxentries=None, **kw):
+        if not path:
+            raise ConfigurationError("SqliteSessionUserCache: path is required")
+        if expires != None:
+            self.expires = expires
+        if maxentries != None:
+            self.maxentries = maxentries
+        self.path = path
+        self._local = threading.local()
+        self._added = 0
+        # the cache may be created before worker processes are forked. the connection used
+        # to create the table is not kept.
+        conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
         try:
-            lock = _thread.allocate_lock()
-            lock.acquire(1)
-            tt = time.time()
-            for v in list(self.__dict__.keys()):
-                if v[:5] == "__c__" and getattr(self, v)[1]+self.expires < tt:
-                    delattr(self, v)
-            if lock.locked():
-                lock.release()
-        except:
-            if lock and lock.locked():
-                lock.release()
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("CREATE TABLE IF NOT EXISTS sessionuser (key TEXT PRIMARY KEY, value BLOB, added REAL)")
+            conn.execute("CREATE INDEX IF NOT EXISTS sessionuser_added ON sessionuser (added)")
+        finally:
+            conn.close()
+
+    def Add(self, obj, id):
+        """
+        Adds or replaces the cache entry for `id`. Removes the oldest entries if 
+        `maxentries` is exceeded.
+        """
+        value = pickle.dumps(obj, pickle.HIGHEST_PROTOCOL)
+        conn = self._Connection()
+        conn.execute("INSERT OR REPLACE INTO sessionuser (key, value, added) VALUES (?,?,?)",
+                     (self._Cachename(id), value, time.time()))
+        self._added += 1
+        if self.maxentries and self._added % self.checkInterval == 0:
+            conn.execute("DELETE FROM sessionuser WHERE key IN "
+                         "(SELECT key FROM sessionuser ORDER BY added DESC LIMIT -1 OFFSET ?)", (self.maxentries,))
+
+    def Get(self, id):
+        """
+        Returns the cached object or None.
+        """
+        rec = self._Connection().execute("SELECT value, added FROM sessionuser WHERE key=?",
+                                         (self._Cachename(id),)).fetchone()
+        if rec is None:
+            return None
+        if self.expires and rec[1]+self.expires < time.time():
+            return None
+        return pickle.loads(rec[0])
+
+    def GetAll(self):
+        """
+        Returns all cached and not expired objects as list.
+        """
+        sql = "SELECT value FROM sessionuser"
+        values = ()
+        if self.expires:
+            sql += " WHERE added >= ?"
+            values = (time.time()-self.expires,)
+        return [pickle.loads(r[0]) for r in self._Connection().execute(sql, values)]
+
+    def Invalidate(self, id):
+        """
+        Removes the cache entry for `id`.
+        """
+        self._Connection().execute("DELETE FROM sessionuser WHERE key=?", (self._Cachename(id),))
+
+    def Purge(self):
+        """
+        Removes all entries older than `expires` seconds. Returns the number of removed entries.
+        Entries never expire if `expires` is 0.
+        """
+        if not self.expires:
+            return 0
+        cursor = self._Connection().execute("DELETE FROM sessionuser WHERE added < ?", (time.time()-self.expires,))
+        return cursor.rowcount
+
+    def Close(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is not None:
+            if self._local.pid == os.getpid():
+                conn.close()
+            self._local.conn = None
 
     def _Cachename(self, id):
-        return "__c__" + str(hash(str(id)))
+        return str(id)
+
+    def _Connection(self):
+        # one connection per thread and process in autocommit mode. sqlite connections must
+        # not be used across fork(), forked processes open a new connection.
+        conn = getattr(self._local, "conn", None)
+        pid = os.getpid()
+        if conn is None or self._local.pid != pid:
+            conn = sqlite3.connect(self.path, timeout=self.timeout, isolation_level=None)
+            self._local.conn = conn
+            self._local.pid = pid
+        return conn
+
+
+class MissingUserCache(object):
+    """
+    Short lived cache for user identities not found in the database. Used to skip database
+    lookups for repeated requests with unknown or inactive identities e.g. stale auth cookies.
+
+    Options: ::
+
+        expires = entries are removed after this many seconds.
+        maxentries = maximum number of cached identities. The oldest entries are removed first.
+
+    """
+    expires = 30
+    maxentries = 10000
+
+    def __init__(self, expires=None, maxentries=None):
+        if expires != None:
+            self.expires = expires
+        if maxentries != None:
+            self.maxentries = maxentries
+        # (ident, activeOnly) -> time added. ordered by time added.
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def Add(self, ident, activeOnly):
+        key = (str(ident), bool(activeOnly))
+        with self._lock:
+            entries = self._entries
+            entries[key] = time.time()
+            entries.move_to_end(key)
+            while len(entries) > self.maxentries:
+                entries.popitem(last=False)
+
+    def IsMissing(self, ident, activeOnly):
+        """
+        Returns True if the identity has recently been looked up without result.
+        """
+        key = (str(ident), bool(activeOnly))
+        with self._lock:
+            added = self._entries.get(key)
+            if added is None:
+                return False
+            if added+self.expires < time.time():
+                del self._entries[key]
+                return False
+            return True
+
+    def Clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+class SingleFlight(object):
+    """
+    Runs a function only once for concurrent calls with the same key. Other callers
+    wait for the running call and share its result.
+
+    Options: ::
+
+        timeout = seconds to wait for a running call. None is returned after the timeout.
+
+    """
+    timeout = 10
+
+    def __init__(self, timeout=None):
+        if timeout != None:
+            self.timeout = timeout
+        self._flights = {}
+        self._lock = threading.Lock()
+
+    def Run(self, key, function):
+        """
+        Returns (result, leader). `leader` is True if the function has been called by this
+        thread. If the function raises an exception waiting threads get None as result.
+        """
+        with self._lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            if not flight.done.wait(self.timeout):
+                return None, False
+            return flight.result, False
+        try:
+            flight.result = function()
+        finally:
+            with self._lock:
+                del self._flights[key]
+            flight.done.set()
+        return flight.result, True
+
+
+class _Flight(object):
+    __slots__ = ("done", "result")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
 
 
 class RootListener(object):
@@ -136,11 +523,21 @@ class RootListener(object):
     def Init(self):
         self.ListenEvent("getuser", self.LookupCache)
         self.ListenEvent("loaduser", self.AddToCache)
+        self.ListenEvent("usernotfound", self.AddMissing)
+        self.ListenEvent("afterAdd", self.ClearMissing)
     
     def LookupCache(self, ident=None, activeOnly=None):
         user = self.app.usercache.Get(ident)
         if user is not None:
             raise UserFound(user)
+        if self.app.usermisses.IsMissing(ident, activeOnly):
+            raise UserFound(None)
+
+    def AddMissing(self, ident=None, activeOnly=None):
+        self.app.usermisses.Add(ident, activeOnly)
+
+    def ClearMissing(self, **kw):
+        self.app.usermisses.Clear()
 
     def AddToCache(self, user=None, lastlogin=None):
         sessionuser = self.SessionUserFactory(user.identity, user)
@@ -148,31 +545,169 @@ class RootListener(object):
         self.app.usercache.Add(sessionuser, user.identity)
         
     def SessionUserFactory(self, ident, user):
-        default = ("id", "title", "pool_state", "name", "email", "surname", "lastname", "groups", "notify", "lastlogin")
-        fields = self.app.configuration.get("sessionuser") or default
-        data = Conf()
-        meta = Conf()
-        app = self.app
-        for f in fields:
-            if app.configurationQuery.GetMetaFld(f):
-                meta[f] = user.meta.get(f)
-            else:
-                data[f] = user.data.get(f)
-        data.lock()
-        meta.lock()
-        return SessionUser(ident, user.id, data, meta)
+        """
+        Creates the session user for a user object or a user record from a search result.
+        Records must contain `id` and all session user fields.
+        """
+        plan = GetSessionUserPlan(self.app)
+        if isinstance(user, dict):
+            return plan.FromRecord(ident, user, structure=self.app.db.structure)
+        return plan.FromObject(ident, user)
 
 
         
 class UserListener(object):
 
     def Init(self):
-        self.ListenEvent("commit", self.InvalidateCache)
+        # the commit handler is registered on init. at this point the user objects own 
+        # commit handlers (e.g. title update) are registered and called first.
+        self.ListenEvent("init", self.ListenCommit)
         self.ListenEvent("logout", self.InvalidateCache)
         self.ListenEvent("delete", self.InvalidateCache)
+        self.ListenEvent("activate", self.ClearMissing)
+        self.ListenEvent("login", self.AddToCache)
+
+    def AddToCache(self, lastlogin=None, **kw):
+        # add the user on login. The first request after login will not have to 
+        # load the user. Inactive users are not cached.
+        if not self.meta.get("pool_state"):
+            return
+        root = self.root
+        if hasattr(root, "AddToCache"):
+            root.AddToCache(user=self, lastlogin=lastlogin)
+
+    def ListenCommit(self, **kw):
+        self.ListenEvent("commit", self.UpdateCache)
+        self.ListenEvent("committed", self.RefreshCache)
+
+    def UpdateCache(self, **kw):
+        """
+        Removes the cached session user before the commit if session user fields, the identity
+        or state are changed. Commits not changing these fields leave the cached user untouched.
+        The entry is replaced with the stored values by `RefreshCache()` after the database 
+        commit succeeded. If the commit fails the user is loaded again on the next request.
+        """
+        self._sessionuser = None
+        changed = set(self.data.GetTemp()) | set(self.meta.GetTemp())
+        if not changed:
+            return
+        app = self.app
+        plan = GetSessionUserPlan(app)
+        identityField = self.parent.identityField
+        if changed & set((identityField, "name", "email", "pool_state")):
+            # commit may add an identity formerly not found
+            app.usermisses.Clear()
+        if changed.isdisjoint(plan.fields) and identityField not in changed and "pool_state" not in changed:
+            return
+        ident = self.identity
+        if identityField in changed:
+            # the previous identity is still stored in the database
+            previous = self.dbEntry.GetDataField(identityField, fromDB=True)
+            app.usercache.Invalidate(previous or str(self.id))
+            app.usercache.Invalidate(ident)
+            return
+        cached = app.usercache.Get(ident)
+        if cached is None:
+            return
+        app.usercache.Invalidate(ident)
+        if self.meta.get("pool_state"):
+            # inactive users are not cached
+            self._sessionuser = cached
+
+    def RefreshCache(self, **kw):
+        """
+        Adds the session user with the committed values if it was cached before the commit.
+        The database is not queried.
+        """
+        cached = getattr(self, "_sessionuser", None)
+        if cached is None:
+            return
+        self._sessionuser = None
+        app = self.app
+        ident = self.identity
+        user = GetSessionUserPlan(app).FromObject(ident, self)
+        user.lastlogin = cached.lastlogin
+        user.currentlogin = cached.currentlogin
+        app.usercache.Add(user, ident)
 
     def InvalidateCache(self, **kw):
         self.app.usercache.Invalidate(self.identity)
+        # name, email or state may have changed. 
+        self.app.usermisses.Clear()
+
+    def ClearMissing(self, **kw):
+        self.app.usermisses.Clear()
+
+
+class SessionUserPlan(object):
+    """
+    Compiled session user field list. Fields are split into data and meta fields once
+    and session users are copied from user objects or search result records without 
+    looking up the field configuration.
+
+    The field list is taken from the application configuration `sessionuser`.
+    """
+    default = ("id", "title", "pool_state", "name", "email", "surname", "lastname", "groups", "notify", "lastlogin")
+
+    def __init__(self, app):
+        fields = app.configuration.get("sessionuser") or self.default
+        datafields = []
+        metafields = []
+        for f in fields:
+            if app.configurationQuery.GetMetaFld(f):
+                metafields.append(f)
+            else:
+                datafields.append(f)
+        self.datafields = tuple(datafields)
+        self.metafields = tuple(metafields)
+        # fields to select if session users are loaded from search results
+        self.fields = self.datafields + self.metafields
+        if "id" not in self.fields:
+            self.fields = ("id",) + self.fields
+        self.layout = GetSessionUserLayout(self.datafields, self.metafields)
+        # database tables used to deserialize search result values
+        datatable = app.configurationQuery.GetObjectConf("user", skipRoot=True).dbparam
+        self.tables = tuple([datatable]*len(self.datafields) + [MetaTbl]*len(self.metafields))
+        self.layoutFields = self.datafields + self.metafields
+        self._record = itemgetter(*self.layoutFields)
+        if len(self.layoutFields) == 1:
+            getter = self._record
+            self._record = lambda record: (getter(record),)
+
+    def FromObject(self, ident, user):
+        """
+        Creates the session user from a user object.
+        """
+        d = user.data.get
+        m = user.meta.get
+        values = tuple([d(f) for f in self.datafields] + [m(f) for f in self.metafields])
+        return SessionUser.FromValues(ident, user.id, self.layout, values, lastlogin=d("lastlogin"))
+
+    def FromRecord(self, ident, record, structure=None):
+        """
+        Creates the session user from a search result record (dictionary) containing all fields.
+        If `structure` (the database structure) is passed database values are deserialized.
+        """
+        values = self._record(record)
+        if structure is not None:
+            de = structure.deserialize
+            values = tuple([de(t, f, v) for t, f, v in zip(self.tables, self.layoutFields, values)])
+        lastlogin = None
+        pos = self.layout.data.get("lastlogin")
+        if pos is not None:
+            lastlogin = values[pos]
+        return SessionUser.FromValues(ident, record["id"], self.layout, values, lastlogin=lastlogin)
+
+
+def GetSessionUserPlan(app):
+    """
+    Returns the compiled session user plan for the app. The plan is created by
+    `SetupRootAndUser` and compiled on first use otherwise.
+    """
+    plan = getattr(app, "sessionuserplan", None)
+    if plan is None:
+        plan = app.sessionuserplan = SessionUserPlan(app)
+    return plan
 
 
 @implementer(ISessionUser)
@@ -189,22 +724,68 @@ class SessionUser(object):
     Updates of user values also removes the user from cache.
      
     Default data values: name, email, surname, lastname, groups
+
+    To keep cached users small values are stored as a single tuple. Field names are 
+    stored once in a `SessionUserLayout` shared by all users with the same fields. 
+    `data` and `meta` are readonly views on the values.
     """
+    __slots__ = ("id", "identity", "lastlogin", "currentlogin", "_layout", "_values", "_groups")
 
     def __init__(self, ident, id, data, meta=None):
-        self.id = id
-        self.identity = ident
-        self.data = data
-        self.meta = meta
+        datafields = tuple(data.keys())
+        metafields = tuple(meta.keys()) if meta is not None else None
+        layout = GetSessionUserLayout(datafields, metafields)
+        values = [data.get(f) for f in datafields]
+        if metafields:
+            values.extend([meta.get(f) for f in metafields])
+        self._Init(ident, id, layout, tuple(values))
         self.lastlogin = data.get("lastlogin")
         self.currentlogin = time.time()
-    
+
+    @classmethod
+    def FromValues(cls, ident, id, layout, values, lastlogin=None, currentlogin=None):
+        """
+        Creates the session user from a layout and a matching tuple of values.
+        """
+        user = cls.__new__(cls)
+        user._Init(ident, id, layout, values)
+        user.lastlogin = lastlogin
+        user.currentlogin = currentlogin or time.time()
+        return user
+
+    def _Init(self, ident, id, layout, values):
+        self.id = id
+        self.identity = ident
+        self._layout = layout
+        self._values = values
+        pos = layout.data.get("groups")
+        self._groups = _InternGroups(values[pos] if pos is not None else None)
+
     def __str__(self):
         return str(self.identity)
 
+    def __reduce__(self):
+        # pickle support for shared cache backends. data and meta are stored as dictionaries.
+        return (_LoadSessionUser, (self.identity, self.id, _Values(self.data), _Values(self.meta), 
+                                   self.lastlogin, self.currentlogin))
+
+    @property
+    def data(self):
+        return SessionUserValues(self._layout.data, self._values)
+
+    @property
+    def meta(self):
+        if self._layout.meta is None:
+            return None
+        return SessionUserValues(self._layout.meta, self._values)
+
     @property
     def groups(self):
         return self.data.groups
+
+    @property
+    def groupset(self):
+        return self._groups
     
     def GetGroups(self, context=None):
         """
@@ -218,48 +799,275 @@ class SessionUser(object):
         check if user has one of these groups
         """
         if isinstance(groups, str):
-            return groups in self.data.groups
-        for g in groups:
-            if g in self.data.groups:
-                return True
-        return False
+            return groups in self._groups
+        return not self._groups.isdisjoint(groups)
     
     def ReadableName(self):
         if self.data.surname or self.data.lastname: 
             return " ".join([self.data.surname, self.data.lastname])
         return self.data.name
+
+
+class SessionUserLayout(object):
+    """
+    Field names of session user values. `data` and `meta` map field names to the position 
+    in the values tuple. `meta` is None if the user has no meta values.
+    """
+    __slots__ = ("data", "meta")
+
+    def __init__(self, datafields, metafields=None):
+        self.data = dict((f, i) for i, f in enumerate(datafields))
+        self.meta = None
+        if metafields is not None:
+            offset = len(datafields)
+            self.meta = dict((f, offset+i) for i, f in enumerate(metafields))
+
+    def __len__(self):
+        return len(self.data) + len(self.meta or ())
+
+
+_layouts = {}
+
+def GetSessionUserLayout(datafields, metafields=None):
+    """
+    Returns the shared layout for the fields.
+    """
+    key = (tuple(datafields), tuple(metafields) if metafields is not None else None)
+    layout = _layouts.get(key)
+    if layout is None:
+        layout = _layouts.setdefault(key, SessionUserLayout(*key))
+    return layout
+
+
+class SessionUserValues(object):
+    """
+    Readonly view on session user data or meta values. Supports the read functions of
+    nive.definitions.Conf.
+    """
+    __slots__ = ("_index", "_values")
+
+    def __init__(self, index, values):
+        self._index = index
+        self._values = values
+
+    def get(self, key, default=None):
+        pos = self._index.get(key)
+        if pos is None:
+            return default
+        return self._values[pos]
+
+    def keys(self):
+        return list(self._index.keys())
+
+    def items(self):
+        return [(k, self._values[pos]) for k, pos in self._index.items()]
+
+    def has_key(self, key):
+        return key in self._index
+
+    def __getattr__(self, key):
+        try:
+            return self._values[self._index[key]]
+        except KeyError:
+            raise AttributeError(key)
+
+    def __setattr__(self, key, value):
+        if key in self.__slots__:
+            return object.__setattr__(self, key, value)
+        raise ConfigurationError("Configuration locked.")
+
+    def __getitem__(self, key):
+        return getattr(self, key)
+
+    def __contains__(self, key):
+        return key in self._index
+
+    def __iter__(self):
+        return iter(self.keys())
+
+    def __len__(self):
+        return len(self._index)
+
+
+# group sets are shared by all users with the same groups
+_groupsets = {}
+_maxgroupsets = 10000
+
+def _InternGroups(groups):
+    if not groups:
+        return frozenset()
+    if isinstance(groups, str):
+        groups = (groups,)
+    try:
+        key = tuple(groups)
+        groupset = _groupsets.get(key)
+    except TypeError:
+        return frozenset(groups)
+    if groupset is None:
+        groupset = frozenset(key)
+        if len(_groupsets) < _maxgroupsets:
+            groupset = _groupsets.setdefault(key, groupset)
+    return groupset
+
+
+def _Values(conf):
+    if conf is None:
+        return None
+    return dict((k, conf.get(k)) for k in conf.keys())
+
+def _LoadSessionUser(ident, id, data, meta, lastlogin, currentlogin):
+    user = SessionUser(ident, id, data, meta)
+    user.lastlogin = lastlogin
+    user.currentlogin = currentlogin
+    return user
     
     
 # session user module definition
 
 def SetupRootAndUser(app, pyramidConfig):
     # get all roots and user and add Listeners
-    def add(confs, extension):
-        for c in confs:
-            e = c.extensions
-            if e == None:
-                e = []
-            elif extension in e:
-                continue
-            if isinstance(e, tuple):
-                e = list(e)
-            e.append(extension)
-            c.unlock()
-            c.extensions = tuple(e)
-            c.lock()
-    
     rootextension = "nive_userdb.extensions.sessionuser.RootListener"
-    add(app.configurationQuery.GetAllRootConfs(), rootextension)
+    AddExtension(app.configurationQuery.GetAllRootConfs(), rootextension)
     userextension = "nive_userdb.extensions.sessionuser.UserListener"
-    add([app.configurationQuery.GetObjectConf("user",skipRoot=True)], userextension)
+    AddExtension([app.configurationQuery.GetObjectConf("user",skipRoot=True)], userextension)
     # add usercache to app
-    app.usercache = SessionUserCache()
+    conf = app.configurationQuery.QueryConfByName(IModuleConf, "sessionuser") or configuration
+    # registration may run more than once. stop the previous cache.
+    close = getattr(getattr(app, "usercache", None), "Close", None)
+    if close is not None:
+        close()
+    app.sessionuserplan = SessionUserPlan(app)
+    backend = GetClassRef(conf.get("backend") or SessionUserCache)
+    options = conf.get("backendOptions") or {}
+    app.usercache = backend(expires=conf.get("expires"),
+                            maxentries=conf.get("maxentries"),
+                            stripes=conf.get("stripes"),
+                            purgeInterval=conf.get("purgeInterval"),
+                            **options)
+    app.usermisses = MissingUserCache(expires=conf.get("missingExpires"))
+    app.userloads = SingleFlight()
+    # restore the cache contents of the last shutdown and preload recently active users
+    app.RemoveListener("close", SaveSnapshot)
+    app.RemoveListener("run", WarmupCache)
+    if conf.get("snapshot") and hasattr(app.usercache, "Dump"):
+        LoadSnapshot(app.usercache, conf.snapshot)
+        app.ListenEvent("close", SaveSnapshot)
+    if conf.get("warmup"):
+        app.ListenEvent("run", WarmupCache)
+
+
+# snapshot format version
+SnapshotVersion = 1
+
+def SaveSnapshot(context, path=None):
+    """
+    Saves the session user cache to the `snapshot` file. Users sharing the same fields
+    are stored as values and a shared field list. Returns the number of saved users.
+    """
+    app = context
+    if path is None:
+        conf = app.configurationQuery.QueryConfByName(IModuleConf, "sessionuser") or configuration
+        path = conf.get("snapshot")
+    if not path:
+        return 0
+    layouts = {}
+    entries = []
+    for key, user, added in app.usercache.Dump():
+        layout = user._layout
+        if layout not in layouts:
+            layouts[layout] = len(layouts)
+        entries.append((key, added, layouts[layout], user.identity, user.id, user._values, 
+                        user.lastlogin, user.currentlogin))
+    fields = [None]*len(layouts)
+    for layout, pos in layouts.items():
+        meta = None
+        if layout.meta is not None:
+            meta = tuple(sorted(layout.meta, key=layout.meta.get))
+        fields[pos] = (tuple(sorted(layout.data, key=layout.data.get)), meta)
+    snapshot = {"version": SnapshotVersion, "layouts": fields, "entries": entries}
+    # write a temporary file first. other processes may read the file at the same time.
+    temp = "%s.%d.tmp" % (path, os.getpid())
+    with open(temp, "wb") as f:
+        pickle.dump(snapshot, f, pickle.HIGHEST_PROTOCOL)
+    os.replace(temp, path)
+    return len(entries)
+
 
+def LoadSnapshot(cache, path):
+    """
+    Loads a snapshot saved by `SaveSnapshot()` into the cache. Expired entries are
+    skipped. Returns the number of loaded users.
+    """
+    try:
+        with open(path, "rb") as f:
+            snapshot = pickle.load(f)
+    except (IOError, OSError):
+        return 0
+    except Exception as e:
+        logging.getLogger("nive_userdb").warning("Session user snapshot %s not loaded: %s", path, str(e))
+        return 0
+    if not isinstance(snapshot, dict) or snapshot.get("version") != SnapshotVersion:
+        return 0
+    layouts = [GetSessionUserLayout(data, meta) for data, meta in snapshot["layouts"]]
+    entries = []
+    for key, added, layout, ident, id, values, lastlogin, currentlogin in snapshot["entries"]:
+        user = SessionUser.FromValues(ident, id, layouts[layout], values, lastlogin, currentlogin)
+        entries.append((key, user, added))
+    return cache.Load(entries)
+
+
+def WarmupCache(app, count=None):
+    """
+    Preloads the `warmup` most recently active users with a single query. Returns the number
+    of added users.
+    """
+    if count is None:
+        conf = app.configurationQuery.QueryConfByName(IModuleConf, "sessionuser") or configuration
+        count = conf.get("warmup")
+    if not count:
+        return 0
+    root = app.root
+    plan = GetSessionUserPlan(app)
+    identityField = root.identityField
+    fields = list(plan.fields)
+    if identityField not in fields:
+        fields.append(identityField)
+    records = root.search.SelectDict(pool_type="user", parameter={"pool_state": 1}, fields=fields,
+                                     sort="lastlogin", ascending=0, max=count)
+    structure = app.db.structure
+    cache = app.usercache
+    added = 0
+    for record in records:
+        ident = record.get(identityField) or str(record["id"])
+        if cache.Get(ident) is not None:
+            continue
+        cache.Add(plan.FromRecord(ident, record, structure=structure), ident)
+        added += 1
+    return added
 
 
 configuration = ModuleConf(
     id = "sessionuser",
     name = "Session user cache",
+    # cache backend class or dotted name. default: SessionUserCache
+    # use "nive_userdb.extensions.sessionuser.SqliteSessionUserCache" to share the cache 
+    # between processes and set backendOptions = {"path": "/path/to/cache.db"}
+    backend = None,
+    backendOptions = None,
+    # cache options. None uses the backend defaults.
+    expires = None,
+    maxentries = None,
+    stripes = None,
+    # seconds between background purge runs. None or 0 = expired entries are removed on access 
+    # and with new entries only.
+    purgeInterval = None,
+    # file to save the cache on shutdown and restore on startup. Only for caches supporting
+    # Dump() and Load() like the default SessionUserCache. 
+    snapshot = None,
+    # number of most recently active users preloaded on startup. 0 = no preloading
+    warmup = 0,
+    # seconds unknown identities are cached. None uses the MissingUserCache default.
+    missingExpires = None,
     events = (Conf(event="startRegistration", callback=SetupRootAndUser),),
 
 )
@@ -0,0 +1,141 @@
+import unittest
+
+from pyramid import testing
+
+from nive.helper import FormatConfTestFailure
+from nive.security import User
+
+from nive_userdb.tests import __local
+from nive_userdb.tests import db_app
+from nive_userdb.extensions.identityindex import IdentityIndex, LoadIdentityIndex, configuration
+
+
+class Conftest(unittest.TestCase):
+
+    def test_conf1(self):
+        r=configuration.test()
+        if not r:
+            return
+        self.fail(FormatConfTestFailure(r))
+
+
+class IdentityIndexTest(unittest.TestCase):
+
+    def _index(self):
+        index = IdentityIndex("token")
+        index.Build([
+            {"id": 1, "pool_state": 1, "name": "user1", "email": "user1@aaa.ccc", "token": "t1"},
+            {"id": 2, "pool_state": 0, "name": "User2", "email": " user2@aaa.ccc ", "token": None},
+            {"id": 3, "pool_state": 1, "name": "user3", "email": "user1@aaa.ccc", "token": ""},
+        ])
+        return index
+
+    def test_get(self):
+        index = self._index()
+        self.assertTrue(index.ready)
+        self.assertTrue(len(index)==3)
+        self.assertTrue(index.Supports("ident"))
+        self.assertFalse(index.Supports("surname"))
+        self.assertTrue(index.Get("name", "user1")==(1,))
+        self.assertTrue(index.Get("name", "USER2")==(2,))
+        self.assertTrue(index.Get("email", "user2@aaa.ccc")==(2,))
+        self.assertTrue(index.Get("email", "user2@aaa.ccc", activeOnly=1)==())
+        self.assertTrue(index.Get("email", "user1@aaa.ccc")==(1,3))
+        self.assertTrue(index.Get("ident", "t1")==(1,))
+        self.assertTrue(index.Get("ident", "T1")==())
+        self.assertTrue(index.Get("ident", "")==())
+        self.assertTrue(index.Get("name", "unknown")==())
+        self.assertTrue(index.MemoryUsage()>0)
+
+    def test_update(self):
+        index = self._index()
+        index.Update(3, {"name": "user3", "email": "user3@aaa.ccc"}, 1)
+        self.assertTrue(index.Get("email", "user1@aaa.ccc")==(1,))
+        self.assertTrue(index.Get("email", "user3@aaa.ccc")==(3,))
+        index.Update(2, {"name": "user2", "email": "user2@aaa.ccc"}, 1)
+        self.assertTrue(index.Get("name", "user2", activeOnly=1)==(2,))
+        index.Remove(1)
+        self.assertTrue(index.Get("name", "user1")==())
+        self.assertTrue(index.Get("ident", "t1")==())
+        index.Remove(1)
+        self.assertTrue(len(index)==2)
+
+    def test_ident_name(self):
+        # names are case insensitive, identities not
+        index = IdentityIndex("name")
+        index.Build([{"id": 1, "pool_state": 1, "name": "User1", "email": "user1@aaa.ccc"}])
+        self.assertTrue(index.Get("name", "user1")==(1,))
+        self.assertTrue(index.Get("ident", "User1")==(1,))
+        self.assertTrue(index.Get("ident", "user1")==())
+
+
+class IndexTest_db(object):
+
+    def setUp(self):
+        request = testing.DummyRequest()
+        request._LOCALE_ = "en"
+        self.request = request
+        self.config = testing.setUp(request=request)
+        self.config.include('pyramid_chameleon')
+        self._loadApp([configuration])
+        self.app.Startup(self.config)
+        self.app.identityindex = LoadIdentityIndex(self.app)
+
+    def tearDown(self):
+        db_app.emptypool(self.app)
+        self.app.Close()
+        testing.tearDown()
+
+    def test_lookup(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        root.DeleteUser(str(root.GetUserByName("user2", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o1,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+        data["name"] = "user2"
+        data["email"] = "user2@aaa.ccc"
+        o2,r = root.AddUser(data, activate=0, generatePW=0, mail=None, groups="", currentUser=user)
+        self.assertTrue(o1 and o2)
+        index = a.identityindex
+        self.assertTrue(index.Get("name", "user1")==(o1.id,))
+        self.assertTrue(index.Get("email", "user2@aaa.ccc", activeOnly=1)==())
+
+        self.assertTrue(root.GetUserByName("user1").id==o1.id)
+        self.assertTrue(root.GetUserByName("user2@aaa.ccc", activeOnly=0).id==o2.id)
+        self.assertFalse(root.GetUserByName("user2"))
+        self.assertFalse(root.GetUserByName("unknown"))
+        # users unknown to the index are loaded from the database
+        index.Remove(o1.id)
+        self.assertTrue(root.GetUserByName("user1").id==o1.id)
+        self.assertTrue(root.FindUserIDs("user1")==(o1.id,))
+        self.assertTrue(root.FindUserIDs("user1@aaa.ccc", ("email",))==(o1.id,))
+        index.UpdateUser(o1)
+        self.assertTrue(root.FindUserIDs("user2@aaa.ccc")==(o2.id,))
+        self.assertTrue(root.FindUserIDs("user2@aaa.ccc", activeOnly=1)==())
+
+        # commit and delete update the index
+        o2.Activate(user)
+        self.assertTrue(root.GetUserByName("user2").id==o2.id)
+        o1.data["email"] = "user1@bbb.ccc"
+        o1.Commit(user)
+        self.assertFalse(root.GetUserByMail("user1@aaa.ccc"))
+        self.assertTrue(root.GetUserByMail("user1@bbb.ccc").id==o1.id)
+        root.DeleteUser("user1")
+        self.assertTrue(index.Get("name", "user1")==())
+
+        # rebuild from database
+        index.Rebuild(a)
+        self.assertTrue(index.Get("name", "user2")==(o2.id,))
+        self.assertTrue(index.Get("name", "user1")==())
+
+
+class IndexTest_db_sqlite(IndexTest_db, __local.SqliteTestCase):
+    pass
+class IndexTest_db_mysql(IndexTest_db, __local.MySqlTestCase):
+    pass
+class IndexTest_db_postgres(IndexTest_db, __local.PostgreSqlTestCase):
+    pass
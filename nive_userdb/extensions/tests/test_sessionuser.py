@@ -1,18 +1,29 @@
 
 
 import unittest
+import threading
 import time
+import tempfile
+import shutil
+import os
+import pickle
+from collections import deque
 
 from nive.helper import FormatConfTestFailure
-from nive.definitions import Conf
+from nive.definitions import Conf, ConfigurationError
 
 from nive_userdb.extensions.sessionuser import SessionUser, SessionUserCache, ISessionUser, configuration
+from nive_userdb.extensions.sessionuser import SqliteSessionUserCache, MissingUserCache, GetSessionUserLayout
+from nive_userdb.extensions.sessionuser import SessionUserPlan, SingleFlight, SaveSnapshot, LoadSnapshot
 from nive_userdb.extensions.sessionuser import RootListener, UserListener, UserFound
+from nive_userdb.root import Userroot
 
 
 class cq(object):
     def GetMetaFld(self, id):
         return True
+    def GetObjectConf(self, id, skipRoot=False):
+        return Conf(dbparam="users")
 
 class testobj(object):
     configuration = Conf()
@@ -74,12 +85,255 @@ class CacheTest(unittest.TestCase):
         self.assertTrue(self.cache.Get("user3"))
         self.assertTrue(len(self.cache.GetAll())==2)
 
+        # entries never expire
         self.cache.expires = 0
-        self.cache.Purge()
+        self.assertTrue(self.cache.Purge()==0)
         self.assertFalse(self.cache.Get("user1"))
-        self.assertFalse(self.cache.Get("user2"))
-        self.assertFalse(self.cache.Get("user3"))
-        self.assertTrue(len(self.cache.GetAll())==0)
+        self.assertTrue(self.cache.Get("user2"))
+        self.assertTrue(self.cache.Get("user3"))
+        self.assertTrue(len(self.cache.GetAll())==2)
+
+    def test_maxentries(self):
+        cache = SessionUserCache(1234, maxentries=2, stripes=1)
+        cache.Add(SessionUser("user1", 1, Conf(), Conf()), "user1")
+        cache.Add(SessionUser("user2", 2, Conf(), Conf()), "user2")
+        # user1 is now the most recently used entry
+        self.assertTrue(cache.Get("user1"))
+        cache.Add(SessionUser("user3", 3, Conf(), Conf()), "user3")
+        self.assertTrue(len(cache.GetAll())==2)
+        self.assertTrue(cache.Get("user1"))
+        self.assertFalse(cache.Get("user2"))
+        self.assertTrue(cache.Get("user3"))
+
+    def test_expires(self):
+        cache = SessionUserCache(1234, stripes=1)
+        cache.Add(SessionUser("user1", 1, Conf(), Conf()), "user1")
+        self.assertTrue(cache.Get("user1"))
+        # move the entry back in time
+        entries = cache._stripes[0].entries
+        obj, added = entries["user1"]
+        entries["user1"] = (obj, added-2000)
+        self.assertFalse(cache.GetAll())
+        self.assertFalse(cache.Get("user1"))
+        self.assertFalse(entries)
+
+    def test_purge(self):
+        cache = SessionUserCache(1234, stripes=1)
+        for i in range(10):
+            cache.Add(SessionUser("user%d"%i, i, Conf(), Conf()), "user%d"%i)
+        stripe = cache._stripes[0]
+        # replaced and invalidated entries leave stale records in the queue
+        cache.Add(SessionUser("user1", 1, Conf(), Conf()), "user1")
+        cache.Invalidate("user2")
+        self.assertTrue(len(stripe.queue)==11)
+        self.assertTrue(cache.Purge()==0)
+        # move all queue records back in time
+        stripe.queue = deque((added-2000, key) for added, key in stripe.queue)
+        for key, e in list(stripe.entries.items()):
+            stripe.entries[key] = (e[0], e[1]-2000)
+        self.assertTrue(cache.Purge()==9)
+        self.assertTrue(cache.evicted==9)
+        self.assertFalse(stripe.entries)
+        self.assertFalse(stripe.queue)
+
+    def test_purge_add(self):
+        cache = SessionUserCache(1234, stripes=1)
+        cache.purgeSteps = 2
+        for i in range(5):
+            cache.Add(SessionUser("user%d"%i, i, Conf(), Conf()), "user%d"%i)
+        stripe = cache._stripes[0]
+        stripe.queue = deque((added-2000, key) for added, key in stripe.queue)
+        for key, e in list(stripe.entries.items()):
+            stripe.entries[key] = (e[0], e[1]-2000)
+        # each add removes up to purgeSteps expired entries
+        cache.Add(SessionUser("user5", 5, Conf(), Conf()), "user5")
+        self.assertTrue(len(stripe.entries)==4)
+        cache.Add(SessionUser("user6", 6, Conf(), Conf()), "user6")
+        self.assertTrue(len(stripe.entries)==3)
+        self.assertTrue(cache.evicted==4)
+
+    def test_compact(self):
+        cache = SessionUserCache(0, stripes=1)
+        for i in range(1000):
+            cache.Add(SessionUser("user1", 1, Conf(), Conf()), "user1")
+        self.assertTrue(len(cache._stripes[0].queue) < 100)
+        self.assertTrue(cache.Get("user1"))
+
+    def test_purge_thread(self):
+        cache = SessionUserCache(0.01, purgeInterval=0.01)
+        cache.Add(SessionUser("user1", 1, Conf(), Conf()), "user1")
+        for i in range(100):
+            if cache.evicted:
+                break
+            time.sleep(0.01)
+        cache.Close()
+        self.assertTrue(cache.evicted==1)
+        self.assertFalse(cache.GetAll())
+
+    def test_threads(self):
+        cache = SessionUserCache(1234, maxentries=500, stripes=8)
+        errors = []
+        def run(n):
+            try:
+                for i in range(2000):
+                    ident = "user%d" % ((i*n) % 800)
+                    cache.Add(SessionUser(ident, i, Conf(), Conf()), ident)
+                    cache.Get(ident)
+                    if i % 10 == 0:
+                        cache.Invalidate(ident)
+                    if i % 500 == 0:
+                        cache.GetAll()
+            except Exception as e:
+                errors.append(e)
+        threads = [threading.Thread(target=run, args=(n,)) for n in range(1, 9)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertFalse(errors)
+        self.assertTrue(len(cache.GetAll()) <= 500 + 8)
+
+
+class SnapshotTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "sessionuser.snapshot")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_dump(self):
+        cache = SessionUserCache(1234, stripes=2)
+        cache.Add(SessionUser("user1", 1, Conf(), Conf()), "user1")
+        cache.Add(SessionUser("user2", 2, Conf(), Conf()), "user2")
+        entries = sorted(cache.Dump(), key=lambda e: e[0])
+        self.assertTrue(len(entries)==2)
+        old = [(k, o, a-2000) for k, o, a in entries if k=="user2"]
+        cache2 = SessionUserCache(1234, stripes=2)
+        self.assertTrue(cache2.Load(entries[:1]+old)==1)
+        self.assertTrue(cache2.Get(entries[0][0]))
+        self.assertFalse(cache2.Get("user2"))
+        # existing entries are kept
+        self.assertTrue(cache2.Load(entries)==1)
+
+    def test_snapshot(self):
+        app = testobj()
+        app.usercache = SessionUserCache(1234)
+        data = Conf(name="user1", groups=("group:editor",), lastlogin=None)
+        app.usercache.Add(SessionUser("user1", 1, data, Conf(pool_state=1)), "user1")
+        app.usercache.Add(SessionUser("user2", 2, Conf(name="user2"), None), "user2")
+        self.assertTrue(SaveSnapshot(app, path=self.path)==2)
+
+        cache = SessionUserCache(1234)
+        self.assertTrue(LoadSnapshot(cache, self.path)==2)
+        user = cache.Get("user1")
+        self.assertTrue(user.data.name=="user1")
+        self.assertTrue(user.meta.pool_state==1)
+        self.assertTrue(user.InGroups("group:editor"))
+        self.assertTrue(cache.Get("user2").meta is None)
+
+        # expired
+        cache = SessionUserCache(0.001)
+        time.sleep(0.01)
+        self.assertTrue(LoadSnapshot(cache, self.path)==0)
+        # missing or broken files
+        self.assertTrue(LoadSnapshot(cache, self.path+"x")==0)
+        with open(self.path, "wb") as f:
+            f.write(b"broken")
+        self.assertTrue(LoadSnapshot(cache, self.path)==0)
+
+
+class MissingCacheTest(unittest.TestCase):
+
+    def test_missing(self):
+        cache = MissingUserCache(expires=1234, maxentries=2)
+        self.assertFalse(cache.IsMissing("user1", 1))
+        cache.Add("user1", 1)
+        self.assertTrue(cache.IsMissing("user1", 1))
+        self.assertTrue(cache.IsMissing("user1", True))
+        self.assertFalse(cache.IsMissing("user1", 0))
+        cache.Add("user2", 1)
+        cache.Add("user3", 1)
+        self.assertFalse(cache.IsMissing("user1", 1))
+        self.assertTrue(cache.IsMissing("user3", 1))
+        cache.Clear()
+        self.assertFalse(cache.IsMissing("user3", 1))
+
+    def test_expires(self):
+        cache = MissingUserCache(expires=0)
+        cache.Add("user1", 1)
+        time.sleep(0.01)
+        self.assertFalse(cache.IsMissing("user1", 1))
+
+
+class SqliteCacheTest(unittest.TestCase):
+
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.dir, "sessionuser.db")
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_shared(self):
+        # two cache instances on the same file, as used by two worker processes
+        cache1 = SqliteSessionUserCache(self.path, expires=1234)
+        cache2 = SqliteSessionUserCache(self.path, expires=1234)
+        data = Conf(name="user1", groups=("group:editor",))
+        data.lock()
+        cache1.Add(SessionUser("user1", 1, data, Conf()), "user1")
+        user = cache2.Get("user1")
+        self.assertTrue(user)
+        self.assertTrue(user.id==1)
+        self.assertTrue(user.data.name=="user1")
+        self.assertTrue(user.InGroups("group:editor"))
+        self.assertTrue(len(cache2.GetAll())==1)
+
+        cache2.Invalidate("user1")
+        self.assertFalse(cache1.Get("user1"))
+        self.assertFalse(cache1.GetAll())
+        cache1.Close()
+        cache2.Close()
+
+    def test_fork(self):
+        if not hasattr(os, "fork"):
+            self.skipTest("fork not supported")
+        cache = SqliteSessionUserCache(self.path, expires=1234)
+        cache.Add(SessionUser("user1", 1, Conf(), Conf()), "user1")
+        conn = cache._Connection()
+        r, w = os.pipe()
+        pid = os.fork()
+        if pid == 0:
+            # forked worker: new connection, shared entries
+            ok = cache._Connection() is not conn and cache.Get("user1").id == 1
+            os.write(w, b"1" if ok else b"0")
+            os._exit(0)
+        os.close(w)
+        result = os.read(r, 1)
+        os.close(r)
+        os.waitpid(pid, 0)
+        self.assertTrue(result == b"1")
+        self.assertTrue(cache._Connection() is conn)
+        cache.Close()
+
+    def test_expires(self):
+        cache = SqliteSessionUserCache(self.path, expires=1234, maxentries=2)
+        cache.checkInterval = 1
+        cache.Add(SessionUser("user1", 1, Conf(), Conf()), "user1")
+        cache.Add(SessionUser("user2", 2, Conf(), Conf()), "user2")
+        cache.Add(SessionUser("user3", 3, Conf(), Conf()), "user3")
+        self.assertTrue(len(cache.GetAll())==2)
+        # entries never expire
+        cache.expires = 0
+        self.assertTrue(cache.Purge()==0)
+        self.assertTrue(len(cache.GetAll())==2)
+        cache._Connection().execute("UPDATE sessionuser SET added = added - 2000")
+        cache.expires = 1234
+        self.assertTrue(cache.Purge()==2)
+        self.assertFalse(cache.GetAll())
+        cache.Close()
+
 
 class ListenerTest(unittest.TestCase):
     
@@ -87,6 +341,7 @@ class ListenerTest(unittest.TestCase):
         r = RootListener()
         r.app = testobj()
         r.app.usercache = SessionUserCache()
+        r.app.usermisses = MissingUserCache()
         user = r.LookupCache(ident="user1", activeOnly=None)
         self.assertFalse(user)
         r.app.usercache.Add(SessionUser("user1", 1, Conf(), Conf()), "user1")
@@ -95,6 +350,7 @@ class ListenerTest(unittest.TestCase):
         u = UserListener()
         u.app = testobj()
         u.app.usercache = SessionUserCache()
+        u.app.usermisses = MissingUserCache()
         u.identity = "user1"
         u.data = Conf()
         u.meta = Conf()
@@ -103,10 +359,131 @@ class ListenerTest(unittest.TestCase):
         self.assertTrue(sessionuser)
         r.AddToCache(sessionuser)
         
+    def test_plan(self):
+        app = testobj()
+        app.configuration = Conf(sessionuser=("id", "name", "groups"))
+        app.configurationQuery = Conf(GetMetaFld=lambda f: f=="id", 
+                                      GetObjectConf=lambda id, skipRoot=False: Conf(dbparam="users"))
+        plan = SessionUserPlan(app)
+        self.assertTrue(plan.datafields==("name", "groups"))
+        self.assertTrue(plan.metafields==("id",))
+        self.assertTrue(plan.fields==("name", "groups", "id"))
+
+        r = RootListener()
+        r.app = app
+        r.app.sessionuserplan = plan
+        self.assertTrue(plan.tables==("users", "users", "pool_meta"))
+        user = plan.FromRecord("user1", {"id": 1, "name": "user1", "groups": ("here",), "pool_state": 1})
+        self.assertTrue(user.id==1)
+        self.assertTrue(user.meta.id==1)
+        self.assertTrue(user.data.name=="user1")
+        self.assertTrue(user.InGroups("here"))
+        self.assertFalse("pool_state" in user.meta)
+
+        u = UserListener()
+        u.data = Conf(name="user1", groups=("here",), email="")
+        u.meta = Conf(id=1, pool_state=1)
+        u.id = 1
+        user2 = r.SessionUserFactory("user1", u)
+        self.assertTrue(user2._layout is user._layout)
+        self.assertTrue(user2._values==user._values)
+
+    def test_missing(self):
+        r = RootListener()
+        r.app = testobj()
+        r.app.usercache = SessionUserCache()
+        r.app.usermisses = MissingUserCache()
+        r.AddMissing(ident="user1", activeOnly=1)
+        try:
+            r.LookupCache(ident="user1", activeOnly=1)
+            self.fail("UserFound not raised")
+        except UserFound as e:
+            self.assertTrue(e.user is None)
+        # not cached for other activeOnly settings
+        r.LookupCache(ident="user1", activeOnly=0)
+        r.ClearMissing()
+        r.LookupCache(ident="user1", activeOnly=1)
+
+        r.AddMissing(ident="user1", activeOnly=1)
+        u = UserListener()
+        u.app = r.app
+        u.identity = "user2"
+        u.InvalidateCache()
+        r.LookupCache(ident="user1", activeOnly=1)
+
+    def test_singleflight(self):
+        lookups = []
+        signals = []
+        started = threading.Event()
+        class root(RootListener):
+            GetUser = Userroot.GetUser
+            GetCachedUser = Userroot.GetCachedUser
+            _LoadUser = Userroot._LoadUser
+            def LookupUser(self, ident=None, activeOnly=None):
+                lookups.append(ident)
+                started.set()
+                time.sleep(0.2)
+                if ident == "unknown":
+                    return None
+                u = UserListener()
+                u.identity = ident
+                u.data = Conf(name=ident)
+                u.meta = Conf(id=1)
+                u.id = 1
+                return u
+            def Signal(self, signal, **kw):
+                signals.append(signal)
+                if signal == "getuser":
+                    self.LookupCache(**kw)
+                elif signal == "loaduser":
+                    self.AddToCache(**kw)
+                elif signal == "usernotfound":
+                    self.AddMissing(**kw)
+        r = root()
+        r.app = testobj()
+        r.app.usercache = SessionUserCache()
+        r.app.usermisses = MissingUserCache()
+        r.app.userloads = SingleFlight()
+
+        results = []
+        def run(ident):
+            results.append(r.GetUser(ident, activeOnly=1))
+        for ident in ("user1", "unknown"):
+            del results[:]
+            started.clear()
+            threads = [threading.Thread(target=run, args=(ident,)) for n in range(20)]
+            threads[0].start()
+            started.wait()
+            for t in threads[1:]:
+                t.start()
+            for t in threads:
+                t.join()
+            self.assertTrue(lookups.count(ident)==1, lookups)
+            self.assertTrue(len(results)==20)
+            if ident == "user1":
+                # the leader gets the user object, all others the session user
+                self.assertTrue(len([u for u in results if isinstance(u, UserListener)])==1)
+                self.assertTrue(len([u for u in results if isinstance(u, SessionUser)])==19)
+            else:
+                self.assertTrue(results==[None]*20)
+        # getuser is fired before the load and not terminated by cache misses
+        self.assertTrue([s for s in signals if s!="getuser"]==["loaduser", "usernotfound"], signals)
+        self.assertTrue(signals[0]=="getuser", signals)
+        self.assertTrue(r.app.usercache.Get("user1"))
+
+    def test_singleflight_error(self):
+        flights = SingleFlight()
+        def fail():
+            raise ValueError()
+        self.assertRaises(ValueError, flights.Run, "key", fail)
+        self.assertTrue(flights.Run("key", lambda: 1)==(1, True))
+        self.assertFalse(flights._flights)
+
     def test_user(self):
         u = UserListener()
         u.app = testobj()
         u.app.usercache = SessionUserCache()
+        u.app.usermisses = MissingUserCache()
         u.identity = "user1"
         u.data = Conf()
         u.id = 1
@@ -148,5 +525,44 @@ class SessionuserTest(unittest.TestCase):
         self.assertTrue(self.user.InGroups("here"))
         self.assertTrue(self.user.InGroups(["there", "ohno"]))
         self.assertFalse(self.user.InGroups(["ahaha", "ohno"]))
+
+    def test_values(self):
+        data = self.user.data
+        self.assertTrue(data.get("name")=="user1")
+        self.assertTrue(data["name"]=="user1")
+        self.assertTrue(data.get("unknown", 1)==1)
+        self.assertTrue("email" in data)
+        self.assertTrue("name" in data.keys())
+        self.assertTrue(("surname", "The") in data.items())
+        self.assertRaises(AttributeError, getattr, data, "unknown")
+        self.assertRaises(ConfigurationError, setattr, data, "name", "user2")
+        self.assertRaises(AttributeError, setattr, self.user, "title", "user2")
+
+    def test_layout(self):
+        user2 = SessionUser("user2", 2, Conf(name="user2", email="", surname="", lastname="", 
+                                             groups=("here",), lastlogin=None), 
+                            Conf(id=2, pool_state=0))
+        self.assertTrue(user2._layout is self.user._layout)
+        self.assertTrue(user2.ReadableName()=="user2")
+        layout = GetSessionUserLayout(("name","groups"), ("id",))
+        self.assertTrue(layout is GetSessionUserLayout(["name","groups"], ["id"]))
+        user3 = SessionUser.FromValues("user3", 3, layout, ("user3", ("here",), 3), lastlogin=1)
+        self.assertTrue(user3.data.name=="user3")
+        self.assertTrue(user3.meta.id==3)
+        self.assertTrue(user3.lastlogin==1)
+        self.assertTrue(user3.InGroups("here"))
+        self.assertTrue(user2._groups is user3._groups)
+        user4 = SessionUser("user4", 4, Conf(name="user4"))
+        self.assertTrue(user4.meta is None)
+        self.assertFalse(user4.InGroups("here"))
+
+    def test_pickle(self):
+        user = pickle.loads(pickle.dumps(self.user))
+        self.assertTrue(user.identity=="user1")
+        self.assertTrue(user.id==1)
+        self.assertTrue(user.data.email=="user@nive.co")
+        self.assertTrue(user.meta.pool_state==1)
+        self.assertTrue(user.lastlogin==self.user.lastlogin)
+        self.assertTrue(user._layout is self.user._layout)
         
         
@@ -11,14 +11,16 @@ mailing options.
 
 import base64, random
 import uuid
-import json
+from itertools import islice
 
 from nive.definitions import RootConf, Conf, IUser
 from nive.definitions import ConfigurationError
 from nive.security import User, AdminUser, IAdminUser, UserFound, Unauthorized
 from nive.container import Root
 from nive_userdb.i18n import _
-from nive_userdb.app import StagUser
+from nive_userdb.app import StagUser, NormalizedFields, NormalizeIdentity
+from nive_userdb.tokens import TokenStore
+from nive_userdb.usergroups import GroupCondition
 
 class Userroot(Root):
     """
@@ -89,9 +91,8 @@ class Userroot(Root):
         if groups:
             data["groups"] = groups
 
-        if not "token" in data:
-            token = self.GenerateID(30)
-            data["token"] = token
+        # activation tokens are stored hashed in the token store
+        token = data.pop("token", None)
 
         data["pool_type"] = "user"
         data["pool_state"] = int(activate)
@@ -104,13 +105,15 @@ class Userroot(Root):
             report.append(_("Sorry. Account could not be created."))
             return None, report
         #obj.Commit(currentUser)
+        if token or not activate:
+            token = self.GetTokenStore().Create(obj.id, "activate", token=token)
         
         app = self.app
         if mail == "default":
             mail = app.configuration.settings.get("signupMail")
         if mail is not None:
             title = mail.title
-            body = mail(user=obj, **kw)
+            body = mail(user=obj, token=token, **kw)
             tool = app.GetTool("sendMail")
             if not tool:
                 raise ConfigurationError("Mail tool 'sendMail' not found")
@@ -204,8 +207,7 @@ class Userroot(Root):
 
         recv = [(newmail, obj.meta.get("title"))]
 
-        token = self.GenerateID(20)
-        obj.data["token"] = token
+        token = self.GetTokenStore().Create(obj.id, "verifymail")
         obj.data["tempcache"] = "verifymail:"+newmail
         obj.Commit(user=currentUser)
 
@@ -213,7 +215,7 @@ class Userroot(Root):
         if mail == "default":
             mail = self.app.configuration.settings.verifyPasswordMail
         title = mail.title
-        body = mail(user=obj, **kw)
+        body = mail(user=obj, token=token, **kw)
         tool = app.GetTool("sendMail")
         if not tool:
             raise ConfigurationError("Mail tool 'sendMail' not found")
@@ -308,9 +310,7 @@ class Userroot(Root):
             return None, report
         recv = [(email, obj.meta.title)]
 
-        token = self.GenerateID(25)
-        obj.data["token"] = token
-        obj.Commit(user=currentUser)
+        token = self.GetTokenStore().Create(obj.id, "reset")
 
         app = self.app
         if mail=="default":
@@ -321,7 +321,7 @@ class Userroot(Root):
         if not mail:
             raise ConfigurationError("Mail template 'resetPasswordMail' is required")
         title = mail.title
-        body = mail(user=obj, **kw)
+        body = mail(user=obj, token=token, **kw)
         tool = app.GetTool("sendMail")
         if not tool:
             raise ConfigurationError("Mail tool 'sendMail' not found")
@@ -362,6 +362,7 @@ class Userroot(Root):
         if not self.Delete(user.id, obj=user, user=currentUser):
             report.append(_("Sorry. An error occurred."))
             return False, report
+        self.GetTokenStore().Remove(user.id)
 
         report.append(_("User deleted."))
         return True, report
@@ -401,20 +402,60 @@ class Userroot(Root):
         Returns the cached session user if available, not the 'real' user object.
         Use `LookupUser()` to make sure the user is actually looked in the database.
         
+        Cached users are returned by `GetCachedUser()` before any event is fired. If 
+        `app.userloads` is set concurrent lookups of the same identity share a single 
+        database load after the getuser event.
+
         events: 
         - getuser(ident, activeOnly)
         - loaduser(user)
+        - usernotfound(ident, activeOnly)
         """
+        user = self.GetCachedUser(ident, activeOnly)
+        if user is not None:
+            return user
         try:
             self.Signal("getuser", ident=ident, activeOnly=activeOnly)
         except UserFound as user:
             return user.user
+        loads = getattr(self.app, "userloads", None)
+        if loads is None:
+            return self._LoadUser(ident, activeOnly)
+        # concurrent lookups of the same identity wait for a single database load
+        result, leader = loads.Run((str(ident), bool(activeOnly)), lambda: (self._LoadUser(ident, activeOnly),))
+        if result is None:
+            # load failed or timed out. continue with the default lookup.
+            return self._LoadUser(ident, activeOnly)
+        user = result[0]
+        if leader or user is None:
+            return user
+        # waiting lookups get the session user instead of the shared user object
+        sessionuser = self.GetCachedUser(ident, activeOnly)
+        if sessionuser is None and hasattr(self, "SessionUserFactory"):
+            sessionuser = self.SessionUserFactory(ident, user)
+        return sessionuser or user
+
+
+    def _LoadUser(self, ident, activeOnly):
         user = self.LookupUser(ident=ident, activeOnly=activeOnly)
         if user:
             self.Signal("loaduser", user=user)
+        else:
+            self.Signal("usernotfound", ident=ident, activeOnly=activeOnly)
         return user
     
 
+    def GetCachedUser(self, ident, activeOnly=1):
+        """
+        Returns the user from `app.usercache` if available or None. Called by `GetUser()` 
+        before the getuser event.
+        """
+        cache = getattr(self.app, "usercache", None)
+        if cache is None:
+            return None
+        return cache.Get(ident)
+
+
     def GetUserByName(self, name, activeOnly=1):
         """ """
         return self.LookupUser(name=name, activeOnly=activeOnly)
@@ -443,82 +484,237 @@ class Userroot(Root):
         return self.LookupUser(id=ident[0][0], activeOnly=activeOnly)
 
 
+    def FindUserIDs(self, value, fields=("name", "email"), activeOnly=0):
+        """
+        Returns the ids of users with one of `fields` = `value`. Fields are searched in order
+        and the ids of the first field with matches are returned. Uses the identity index
+        if available. Values unknown to the index are looked up in the database. Name and 
+        email are compared case insensitive if the normalized columns exist.
+        returns tuple of ids
+        """
+        index = getattr(self.app, "identityindex", None)
+        normalized = self.GetUserLookup().normalized
+        for field in fields:
+            ids = ()
+            if index is not None and field in ("name", "email") and index.Supports(field):
+                ids = index.Get(field, value, activeOnly)
+            if not ids:
+                if field in normalized:
+                    ids = self._SelectUserIDs(normalized[field], NormalizeIdentity(value), activeOnly)
+                if not ids and (not field in normalized or not self.IdentitiesNormalized()):
+                    # rows not normalized yet are matched exactly
+                    ids = self._SelectUserIDs(field, value, activeOnly)
+            if ids:
+                return ids
+        return ()
+
+
+    def _SelectUserIDs(self, field, value, activeOnly):
+        parameter = {field: value}
+        if activeOnly:
+            parameter["pool_state"] = 1
+        return tuple(r[0] for r in self.search.Select(pool_type="user", parameter=parameter, fields=["id"],
+                                                      max=2, operators=dict((k, "=") for k in parameter)))
+
+
     def LookupUser(self, id=None, ident=None, name=None, email=None, activeOnly=1, reloadFromDB=0):
         """ 
         reloadFromDB deprecated. will be removed in the future
         """
         if not id:
-            loginByEmail = self.app.configuration.get("loginByEmail", True)
-            # lookup adminuser
-            admin = self.app.configuration.get("admin")
-            if admin:
-                if ident and ident == admin.get(self.identityField):
-                    return AdminUser(admin, admin[self.identityField])
-                elif name and name == admin["name"]:
-                    return AdminUser(admin, admin.get(self.identityField))
-                elif loginByEmail and email and email == admin["email"]:
-                    return AdminUser(admin, admin.get(self.identityField))
-            # lookup id for name, email or ident
-            param = dict()
-            if activeOnly:
-                param["pool_state"] = 1
-            if name:
-                param["name"] = name
-            elif email:
-                param["email"] = email
-            elif ident:
-                if not self.identityField:
-                    raise ValueError("user identity field not set")
-                param[self.identityField] = ident
-
-            user = self.search.Select(pool_type="user", parameter=param, fields=["id"], max=2)
-            
-            # check multiple identity fields
-            if len(user)==0 and self.app.configuration.get("identityFallbackAlternative", True):
-                if name:
-                    del param["name"]
-                    param["email"] = name
-                    user = self.search.Select(pool_type="user", parameter=param, fields=["id"], max=2)
-                elif email:
-                    del param["email"]
-                    param["name"] = email
-                    user = self.search.Select(pool_type="user", parameter=param, fields=["id"], max=2)
-                else:
-                    return None
-
-            if len(user)!=1:
-                return None
-            id = user[0][0]
-            
+            return self.GetUserLookup().Lookup(self, ident=ident, name=name, email=email, activeOnly=activeOnly)
         user = self.GetObj(id)
         if not user or (activeOnly and not user.meta.get("pool_state")==1):
             return None
         return user
+
+
+    def GetUserLookup(self):
+        """
+        Returns the compiled user lookup for the application configuration. The lookup is 
+        compiled on first use and reset if the application is registered again.
+        """
+        lookup = getattr(self.app, "userlookup", None)
+        if lookup is None or lookup.identityField != self.identityField:
+            lookup = self.app.userlookup = UserLookup(self.app.configuration, self.identityField, 
+                                                      normalized=self.GetNormalizedFields())
+        return lookup
     
 
-    def GetUserForToken(self, token, activeOnly=True):
+    def GetNormalizedFields(self):
         """
-        Looks up the user for the token
-        requires fld token in user record
-        returns tuple: the user object or None
+        Returns the normalized shadow columns of the user type as dictionary field -> column
         """
-        if not token:
+        fields = [f.id for f in self.app.configurationQuery.GetObjectConf("user", skipRoot=True).data]
+        return dict((field, norm) for field, norm in NormalizedFields.items() if norm in fields)
+    
+
+    def IdentitiesNormalized(self):
+        """
+        True if the normalized columns of all users are filled. Until then name and email 
+        lookups missing the normalized columns are repeated on the original columns. The
+        database is checked once per process and again after `nive_userdb.tools.normalizeIdentities`
+        has run.
+        """
+        lookup = self.GetUserLookup()
+        if lookup.backfilled is None:
+            lookup.backfilled = not self._SelectNotNormalized()
+        return lookup.backfilled
+
+
+    def _SelectNotNormalized(self):
+        normalized = self.GetNormalizedFields()
+        if not normalized:
             return None
+        db = self.app.db
+        table = self.app.configurationQuery.GetObjectConf("user", skipRoot=True).dbparam
+        condition = " OR ".join(["((%s = '' OR %s IS NULL) AND %s <> '')" % (norm, norm, field) 
+                                 for field, norm in sorted(normalized.items())])
+        records = db.Query("SELECT id FROM %s WHERE %s LIMIT 1" % (table, condition), [])
+        return records[0][0] if records else None
+    
 
-        p = {"token": token}
+    def _LoadUserRecord(self, field, value, alternative=None, activeOnly=1, exact=None):
+        """
+        Loads the user with `field` = `value` including meta and data in a single query. 
+        If `alternative` is set users with `alternative` = `value` are selected in the same 
+        query and used if no user matches `field`. The lookup fails if more than one user 
+        matches.
+        `exact` is used to select one of multiple users matching normalized columns: tuple
+        (field, alternative, value) of the original columns.
+        returns the user object or None
+        """
+        app = self.app
+        db = app.db
+        conf = app.configurationQuery.GetObjectConf("user", skipRoot=True)
+        table = conf.dbparam
+        param, operators = self.ObjQueryRestraints(self)
+        param["pool_type"] = "user"
+        param["pool_unitref"] = self.id
         if activeOnly:
-            p["pool_state"] = 1
-        users = self.search.Select(pool_type="user",
-                            parameter=p,
-                            fields=["id"],
-                            max=2)
-        if len(users) != 1:
+            param["pool_state"] = 1
+        condition = None
+        extraValues = None
+        if alternative:
+            ph = db.placeholder
+            fld = lambda f: ("meta__." if app.configurationQuery.GetMetaFld(f) else "data__.") + f
+            condition = "(%s = %s OR %s = %s)" % (fld(field), ph, fld(alternative), ph)
+            extraValues = [value, value]
+        else:
+            param[field] = value
+        fldsm = list(db.structure.get(db.MetaTable))
+        fldsd = list(db.structure.get(table))
+        sql, values = db.FmtSQLSelect(fldsm+fldsd, parameter=param, dataTable=table, operators=operators,
+                                      condition=condition, extraValues=extraValues)
+        recs = db.Query(sql, values)
+        records = [(db.ConvertRecToDict(r[:len(fldsm)], fldsm), db.ConvertRecToDict(r[len(fldsm):], fldsd)) for r in recs]
+        if alternative:
+            # the database may compare case insensitive
+            value = str(value).lower()
+            match = lambda r, f: str((r[0] if f in r[0] else r[1]).get(f)).lower() == value
+            matches = [r for r in records if match(r, field)]
+            if not matches:
+                matches = [r for r in records if match(r, alternative)]
+            records = matches
+        if len(records)>1 and exact:
+            # names or emails only differing in case
+            field, alternative, value = exact
+            get = lambda r, f: (r[0] if f in r[0] else r[1]).get(f)
+            matches = [r for r in records if get(r, field)==value]
+            if not matches and alternative:
+                matches = [r for r in records if get(r, alternative)==value]
+            records = matches
+        if len(records)!=1:
+            return None
+        meta, data = records[0]
+        return self._UserFromRecord(meta, data, conf)
+
+
+    def _UserFromRecord(self, meta, data, conf):
+        """
+        Creates the user object from the selected meta and data record without querying the
+        database again.
+
+        Events:
+        - loadObj(obj)
+        """
+        db = self.app.db
+        entry = db._GetPoolEntry(meta["id"], pool_dataref=meta["pool_dataref"], pool_datatbl=meta["pool_datatbl"], preload="skip")
+        meta = db.structure.deserialize(db.MetaTable, None, meta)
+        data = db.structure.deserialize(conf.dbparam, None, data)
+        entry._UpdateCache(meta=meta, data=data)
+        obj = self.factory.DbObj(meta["id"], dbEntry=entry, configuration=conf)
+        self.Signal("loadObj", obj)
+        return obj
+
+
+    def GetUsersByIDs(self, ids, activeOnly=1, fields=None):
+        """
+        Loads the users for a list of user ids with as few queries as possible. Ids are
+        selected in chunks below the database parameter limit. User objects are loaded by
+        `GetObjsBatch()`. Unknown ids are skipped.
+
+        ids: list of user ids
+        fields: if set only these fields are selected and the users are returned as
+                dictionaries instead of objects. `id` is always included.
+        returns list of users in the order of `ids`
+        """
+        userids = []
+        for i in ids:
+            try:
+                userids.append(int(i))
+            except (TypeError, ValueError):
+                continue
+        if fields:
+            return list(self._IterUserRecords("id", userids, fields, activeOnly))
+        chunk = ParameterChunk(self.app.db)
+        users = {}
+        for pos in range(0, len(userids), chunk):
+            for obj in self.GetObjsBatch(list(set(userids[pos:pos+chunk]))):
+                if obj.meta.get("pool_type")!="user":
+                    continue
+                if activeOnly and obj.meta.get("pool_state")!=1:
+                    continue
+                users[obj.id] = obj
+        return [users[i] for i in userids if i in users]
+
+
+    def GetUserForToken(self, token, activeOnly=True, purpose=None):
+        """
+        Looks up the user for the token in the token store. Expired tokens and tokens 
+        with a different purpose are ignored. Activation tokens stored in the users `token` 
+        field by previous versions are still accepted for inactive accounts.
+        returns tuple: the user object or None
+        """
+        if not token:
             return None
-        id = users[0][0]
+
+        id = self.GetTokenStore().Lookup(token, purpose)
+        if id is None:
+            # legacy tokens do not expire and are only used to activate accounts
+            if activeOnly or purpose not in (None, "activate"):
+                return None
+            p = {"token": token, "pool_state": 0}
+            users = self.search.Select(pool_type="user",
+                                parameter=p,
+                                fields=["id"],
+                                max=2)
+            if len(users) != 1:
+                return None
+            id = users[0][0]
         obj = self.GetObj(id)
+        if obj is None or (activeOnly and not obj.meta.get("pool_state")==1):
+            return None
         return obj
 
 
+    def GetTokenStore(self):
+        """
+        Returns the token store for activation, password reset and email verification tokens
+        """
+        return TokenStore(self.app)
+
+
     # user infos -----------------------------------------------------------------------
 
     def GetUsers(self, **kw):
@@ -530,44 +726,217 @@ class Userroot(Root):
         return self.search.SearchType("user", {"pool_state":1}, fields)
 
 
+    def IterUsers(self, fields=None, activeOnly=True, batch=1000):
+        """
+        Iterates all users as dictionaries ordered by id. Users are selected in batches of
+        `batch` records starting after the last id of the previous batch, so memory usage
+        does not depend on the number of users. Use for sync jobs and exports instead of
+        `GetUsers()`.
+
+        fields: list of fields to select. `id` is always included.
+        """
+        if not fields:
+            fields = ["id", "name", "email", "title", "groups", "lastlogin"]
+        if not "id" in fields:
+            fields = list(fields)
+            fields.append("id")
+        last = 0
+        while True:
+            param = {"id": last}
+            if activeOnly:
+                param["pool_state"] = 1
+            records = self.search.SelectDict(pool_type="user", parameter=param, fields=list(fields),
+                                             operators={"id":">"}, sort="id", ascending=1, max=batch)
+            for r in records:
+                yield r
+            if len(records) < batch:
+                break
+            last = records[-1]["id"]
+
+
     def GetUserInfos(self, userids, fields=None, activeOnly=True):
         """
+        Returns the users for the identities in `userids` as list of dictionaries in the
+        order of `userids`. Each user is returned once. See `IterUserInfos()`.
+        """
+        infos = []
+        found = set()
+        for info in self.IterUserInfos(userids, fields=fields, activeOnly=activeOnly):
+            ident = str(info[self.identityField])
+            if ident in found:
+                continue
+            found.add(ident)
+            infos.append(info)
+        return infos
+
+
+    def IterUserInfos(self, userids, fields=None, activeOnly=True, chunk=None):
+        """
+        Generator version of `GetUserInfos()` for long identity lists. The identities are
+        selected in chunks sized for the database parameter limit and the users are yielded
+        as dictionaries in the order of `userids`. Unknown identities are skipped, duplicate
+        identities are yielded again.
+
+        userids: iterable of user identities
+        fields: list of fields to select. The identity field is always included.
+        chunk: number of identities per query. limited by the database parameter limit.
         """
-        param = {self.identityField:userids}
-        if activeOnly:
-            param["pool_state"] = 1
         if not fields:
             fields = ["id", "name", "email", "title", "groups", "lastlogin"]
-        if not self.identityField in fields:
+        return self._IterUserRecords(self.identityField, userids, fields, activeOnly, chunk)
+
+
+    def _IterUserRecords(self, identity, userids, fields, activeOnly, chunk=None):
+        """
+        Selects the users with `identity` in `userids` in chunks and yields the records as
+        dictionaries in the order of `userids`.
+        """
+        if not identity in fields:
             fields = list(fields)
-            fields.append(self.identityField)
-        return self.search.SelectDict(pool_type="user",
-                               parameter=param, fields=fields, operators={self.identityField:"IN"})
+            fields.append(identity)
+        chunk = ParameterChunk(self.app.db, chunk or 500)
+        userids = iter(userids)
+        while True:
+            ids = list(islice(userids, chunk))
+            if not ids:
+                break
+            param = {identity: list(set(ids))}
+            if activeOnly:
+                param["pool_state"] = 1
+            records = self.search.SelectDict(pool_type="user", parameter=param, fields=list(fields),
+                                             operators={identity:"IN"})
+            records = dict([(str(r[identity]), r) for r in records])
+            for i in ids:
+                r = records.get(str(i))
+                if r is not None:
+                    yield r
 
     
     def GetUsersWithGroup(self, group, fields=None, activeOnly=True):
         """
+        Returns the users assigned to `group` as list of dictionaries. Members are selected
+        by exact match on the user group relation table.
         """
-        param = {"groups":group}
-        if activeOnly:
-            param["pool_state"] = 1
-        operators = {"groups": "LIKE"}
         if not fields:
             fields = ["name","groups"]
         elif not "groups" in fields:
             fields = list(fields)
             fields.append("groups")
-        users = self.search.SelectDict(pool_type="user", parameter=param, fields=fields, operators=operators)
-        # verify groups
-        verified = []
-        for u in users:
-            try:
-                g = json.loads(u["groups"])
-            except ValueError:
-                continue
-            if group in g:
-                verified.append(u)
-        return verified
+        app = self.app
+        db = app.db
+        table = app.configurationQuery.GetObjectConf("user", skipRoot=True).dbparam
+        param = {"pool_type": "user"}
+        if activeOnly:
+            param["pool_state"] = 1
+        condition, values = GroupCondition(db, group)
+        sql, values = db.FmtSQLSelect(fields, parameter=param, dataTable=table, condition=condition, extraValues=values)
+        return [dict(zip(fields, r)) for r in db.Query(sql, values)]
+
+
+class UserLookup(object):
+    """
+    Compiled user lookup. The configuration settings `loginByEmail`, `identityFallbackAlternative`
+    and `admin` are resolved once. The admin user is looked up by name, email and identity in
+    a dictionary.
+    """
+
+    def __init__(self, configuration, identityField, normalized=None):
+        self.identityField = identityField
+        fallback = configuration.get("identityFallbackAlternative", True)
+        # lookup key -> (field, alternative field)
+        self.fields = {
+            "name": ("name", "email" if fallback else None),
+            "email": ("email", "name" if fallback else None),
+            "ident": (identityField, None)
+        }
+        # field -> normalized shadow column. name and email lookups are case insensitive 
+        # if both columns exist.
+        self.normalized = normalized or {}
+        # all rows normalized. see Userroot.IdentitiesNormalized()
+        self.backfilled = None
+        self.columns = {}
+        if "name" in self.normalized and "email" in self.normalized:
+            for key in ("name", "email"):
+                field, alternative = self.fields[key]
+                self.columns[key] = (self.normalized[field], self.normalized.get(alternative))
+        # (lookup key, value) -> (admin, identity)
+        self.admins = {}
+        admin = configuration.get("admin")
+        if admin:
+            identity = admin.get(identityField)
+            if identity:
+                self.admins[("ident", identity)] = (admin, identity)
+            if admin.get("name"):
+                self.admins[("name", admin["name"])] = (admin, identity)
+            if configuration.get("loginByEmail", True) and admin.get("email"):
+                self.admins[("email", admin["email"])] = (admin, identity)
+
+    def Lookup(self, root, ident=None, name=None, email=None, activeOnly=1):
+        """
+        Returns the admin user or the user object for ident, name or email.
+        """
+        if self.admins:
+            for key, value in (("ident", ident), ("name", name), ("email", email)):
+                if value:
+                    admin = self.admins.get((key, value))
+                    if admin is not None:
+                        return AdminUser(*admin)
+        if name:
+            key, value = "name", name
+        elif email:
+            key, value = "email", email
+        elif ident:
+            if not self.identityField:
+                raise ValueError("user identity field not set")
+            key, value = "ident", ident
+        else:
+            return None
+        field, alternative = self.fields[key]
+        user = None
+        index = getattr(root.app, "identityindex", None)
+        # identities are indexed as `ident` and compared exactly
+        indexkey, indexalternative = ("ident", None) if key=="ident" else (field, alternative)
+        if index is not None and index.Supports(indexkey):
+            # resolve the id in memory. values unknown to the index, e.g. users added by
+            # other processes, are looked up in the database.
+            ids = index.Get(indexkey, value, activeOnly)
+            if not ids and indexalternative:
+                ids = index.Get(indexalternative, value, activeOnly)
+            if len(ids)==1:
+                user = root._LoadUserRecord("id", ids[0], None, activeOnly)
+        if user is None and key in self.columns:
+            norm, normalternative = self.columns[key]
+            user = root._LoadUserRecord(norm, NormalizeIdentity(value), normalternative, activeOnly,
+                                        exact=(field, alternative, value))
+            if user is None and not root.IdentitiesNormalized():
+                # rows not normalized yet (see nive_userdb.tools.normalizeIdentities) are 
+                # matched exactly.
+                user = root._LoadUserRecord(field, value, alternative, activeOnly)
+        elif user is None:
+            user = root._LoadUserRecord(field, value, alternative, activeOnly)
+        if not user or (activeOnly and not user.meta.get("pool_state")==1):
+            return None
+        return user
+
+
+# maximum number of sql parameters by database class name prefix
+ParameterLimits = {"Sqlite": 999, "MySql": 65535, "Postgres": 32767}
+
+def ParameterChunk(db, size=500):
+    """
+    Returns the number of values to be passed in a single `IN` query. `size` is reduced
+    to stay below the database parameter limit.
+    """
+    name = db.__class__.__name__
+    for prefix, limit in ParameterLimits.items():
+        if name.startswith(prefix):
+            return min(size, limit-10)
+    return size
+
+
+def ResetUserLookup(app, pyramidConfig):
+    # configuration may change on registration
+    app.userlookup = None
 
 
 
@@ -581,6 +950,7 @@ configuration = RootConf(
     default = 1,
     subtypes = "*",
     name = _("User account"),
+    events = (Conf(event="startRegistration", callback=ResetUserLookup),),
     description = __doc__
 )
 
@@ -28,9 +28,13 @@ def app_db(confs=None):
         db.Execute("select id from users where id=1", cursor=cursor)
         db.Execute("select id from users where token='1'", cursor=cursor)
         db.Execute("select id from users where tempcache='1'", cursor=cursor)
+        db.Execute("select id from users where namenorm='1' and emailnorm='1'", cursor=cursor)
+        db.Execute("select id from users_tokens where tokenkey='1'", cursor=cursor)
+        db.Execute("select userid from users_groups where groupid='1'", cursor=cursor)
         db.Execute("select id from pool_files where id=1", cursor=cursor)
     except:
         app.GetTool("nive.tools.dbStructureUpdater")()
+    app.GetTool("nive_userdb.tools.dbIndexUpdater")()
     return app
 
 def app_nodb():
@@ -53,6 +57,8 @@ def emptypool(app):
     db.Execute("delete FROM pool_groups", cursor=cursor)
     db.Execute("delete FROM pool_sys", cursor=cursor)
     db.Execute("delete FROM users", cursor=cursor)
+    db.Execute("delete FROM users_tokens", cursor=cursor)
+    db.Execute("delete FROM users_groups", cursor=cursor)
     cursor.close()
     db.Commit()
 
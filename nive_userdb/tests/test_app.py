@@ -6,8 +6,15 @@ import AuthEncoding
 from nive_userdb.tests import __local
 from nive_userdb.tests import db_app
 
-from nive.security import User
-
+from nive.security import User, IAdminUser
+from nive.definitions import implementer, ILocalGroups
+
+from nive_userdb.extensions.sessionuser import WarmupCache
+from nive_userdb.root import ResetUserLookup
+from nive_userdb.tools.dbIndexUpdater import GetIndexes, UpdateIndexes
+from nive_userdb.tools.normalizeIdentities import NormalizeUsers, NormalizedCollisions
+from nive_userdb.usergroups import SyncUserGroups
+from nive_userdb.userloader import GetUserLoader, UserLoader
 from nive_userdb.app import UsernameValidator, EmailValidator, IsReservedUserName, Invalid
 
 
@@ -73,11 +80,30 @@ class ObjectTest_db(object):
         self.assertTrue(len(root.GetUserInfos([str(root.GetUserByName("user1", activeOnly=0)), 
                                             str(root.GetUserByName("user2", activeOnly=0))], 
                                            fields=["name", "email", "title"], activeOnly=1))==2)
+        ids = [str(root.GetUserByName(n, activeOnly=0)) for n in ("user3", "user2", "unknown", "user1", "user2")]
+        infos = list(root.IterUserInfos(ids, fields=["email"], activeOnly=0, chunk=2))
+        self.assertTrue([i["email"] for i in infos]==["user3@aaa.ccc", "user2@aaa.ccc", "user1@aaa.ccc", "user2@aaa.ccc"], infos)
+        self.assertTrue(sorted(infos[0].keys())==sorted(["email", root.identityField]))
+        infos = root.GetUserInfos(ids, fields=["email"], activeOnly=1)
+        self.assertTrue([i["email"] for i in infos]==["user2@aaa.ccc", "user1@aaa.ccc"], infos)
 
         self.assertTrue(len(root.GetUsersWithGroup("group:author", fields=["name"], activeOnly=1)))
         self.assertTrue(len(root.GetUsersWithGroup("group:editor", fields=["name"], activeOnly=0)))
         self.assertFalse(len(root.GetUsersWithGroup("group:editor", fields=["name"], activeOnly=1)))
         self.assertTrue(len(root.GetUsers()))
+        users = list(root.IterUsers(fields=["name"], activeOnly=0, batch=1))
+        names = [u["name"] for u in users]
+        self.assertTrue("user1" in names and "user2" in names and "user3" in names, names)
+        self.assertTrue([u["id"] for u in users]==sorted([u["id"] for u in users]))
+        names = [u["name"] for u in root.IterUsers(fields=["name"], batch=2)]
+        self.assertTrue("user1" in names and not "user3" in names, names)
+        u1, u3 = root.GetUserByName("user1", activeOnly=0), root.GetUserByName("user3", activeOnly=0)
+        users = root.GetUsersByIDs([str(u3.id), "x", 999999999, u1.id], activeOnly=0)
+        self.assertTrue([u.id for u in users]==[u3.id, u1.id])
+        self.assertTrue(users[0].data.email=="user3@aaa.ccc" and users[0].meta.pool_state==0)
+        self.assertTrue([u.id for u in root.GetUsersByIDs([u3.id, u1.id], activeOnly=1)]==[u1.id])
+        users = root.GetUsersByIDs([u3.id, u1.id], activeOnly=0, fields=["name"])
+        self.assertTrue(users==[{"name": "user3", "id": u3.id}, {"name": "user1", "id": u1.id}], users)
         
         root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
         root.DeleteUser(str(root.GetUserByName("user2", activeOnly=0)))
@@ -210,6 +236,397 @@ class ObjectTest_db(object):
         self.assertTrue(AuthEncoding.pw_validate(o.data.password, "33333"))
 
 
+    def test_sessionuser_record(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="group:author", currentUser=user)
+        self.assertTrue(o,r)
+
+        plan = a.sessionuserplan
+        recs = root.search.Select(pool_type="user", parameter={"name": "user1"}, fields=list(plan.fields), max=1)
+        self.assertTrue(len(recs)==1)
+        record = dict(zip(plan.fields, recs[0]))
+        sessionuser = root.SessionUserFactory("user1", record)
+        self.assertTrue(sessionuser.id==o.id)
+        self.assertTrue(sessionuser.data.email=="user1@aaa.ccc")
+        self.assertTrue(sessionuser.InGroups("group:author"))
+        self.assertTrue(sessionuser._values==root.SessionUserFactory("user1", o)._values)
+
+        root.DeleteUser(str(o))
+
+
+    def test_login_cache(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+        self.assertTrue(o,r)
+        a.usercache.Invalidate(o.identity)
+
+        l,r = root.Login("user1", "11111", raiseUnauthorized = 0)
+        self.assertTrue(l,r)
+        cached = a.usercache.Get(l.identity)
+        self.assertTrue(cached)
+        self.assertTrue(cached.id==l.id)
+        self.assertTrue(cached.lastlogin==l.previousLogin)
+        self.assertTrue(root.GetUser(l.identity) is cached)
+        self.assertTrue(root.GetCachedUser(l.identity) is cached)
+        # cache hits do not fire events
+        root.Signal = None
+        try:
+            self.assertTrue(root.GetUser(l.identity) is cached)
+        finally:
+            del root.Signal
+        root.Logout(l.identity)
+        self.assertFalse(a.usercache.Get(l.identity))
+
+        root.DeleteUser(str(o))
+
+
+    def test_commit_cache(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        root.DeleteUser(str(root.GetUserByName("user1b", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+        self.assertTrue(o,r)
+
+        l,r = root.Login("user1", "11111", raiseUnauthorized = 0)
+        cached = a.usercache.Get("user1")
+        self.assertTrue(cached)
+
+        # fields not cached
+        l.data["tempcache"] = "firstrun"
+        l.Commit(user)
+        self.assertTrue(a.usercache.Get("user1") is cached)
+
+        # cached fields are updated in place
+        l.data["surname"] = "new"
+        l.Commit(user)
+        updated = a.usercache.Get("user1")
+        self.assertTrue(updated is not cached)
+        self.assertTrue(updated.data.surname=="new")
+        self.assertTrue(updated.lastlogin==cached.lastlogin)
+
+        # failed commits do not change the cache
+        def fail(user=None):
+            raise ValueError("commit failed")
+        l.dbEntry.Commit = fail
+        l.UpdateGroups(["group:admin"])
+        self.assertRaises(ValueError, l.Commit, user)
+        del l.dbEntry.Commit
+        l.dbEntry.Undo()
+        self.assertFalse(a.usercache.Get("user1"))
+        self.assertFalse(root.GetUser("user1").InGroups("group:admin"))
+        l = root.GetUserByName("user1")
+
+        # identity changes
+        l.data["name"] = "user1b"
+        l.Commit(user)
+        self.assertFalse(a.usercache.Get("user1"))
+        self.assertFalse(a.usercache.Get("user1b"))
+        self.assertTrue(root.GetUser("user1b"))
+        self.assertTrue(a.usercache.Get("user1b"))
+
+        # deactivated users are removed
+        l.DeActivate(user)
+        self.assertFalse(a.usercache.Get("user1b"))
+
+        root.DeleteUser(str(l))
+
+
+    def test_warmup(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="group:author", currentUser=user)
+        self.assertTrue(o,r)
+        root.Login("user1", "11111", raiseUnauthorized = 0)
+        a.usercache.Invalidate("user1")
+
+        self.assertTrue(WarmupCache(a, count=1000))
+        cached = a.usercache.Get("user1")
+        self.assertTrue(cached)
+        self.assertTrue(cached.id==o.id)
+        self.assertTrue(cached.InGroups("group:author"))
+        self.assertFalse(WarmupCache(a, count=0))
+
+        root.DeleteUser(str(o))
+
+
+    def test_userloader(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        root.DeleteUser(str(root.GetUserByName("user2", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o1,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="group:author", currentUser=user)
+        data["name"] = "user2"
+        data["email"] = "user2@aaa.ccc"
+        o2,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+        a.usercache.Invalidate("user1")
+        a.usercache.Invalidate("user2")
+
+        loader = GetUserLoader(self.request, a)
+        self.assertTrue(GetUserLoader(self.request, a) is loader)
+        loader.Add(["user1", "user2", "unknown"])
+        statements, stop = self._countQueries()
+        try:
+            u1 = loader.Get("user1")
+            self.assertTrue(len([s for s in statements if s.lstrip().upper().startswith("SELECT")])==1, statements)
+            self.assertTrue(loader.Get("user2").id==o2.id)
+            self.assertTrue(loader.Get("unknown") is None)
+            self.assertTrue([u.id if u else None for u in loader.GetMany(["user2", "unknown", "user1"])]==[o2.id, None, o1.id])
+            self.assertTrue(len([s for s in statements if s.lstrip().upper().startswith("SELECT")])==1, statements)
+        finally:
+            stop()
+        self.assertTrue(u1.id==o1.id and u1.InGroups("group:author"))
+        self.assertTrue(a.usercache.Get("user1") is u1)
+        # identities not found are cached like in GetUser()
+        self.assertTrue(a.usermisses.IsMissing("unknown", 1))
+
+        # principals resolve users through the request loader
+        self.request.environ.pop("authenticated_user", None)
+        loader.Invalidate()
+        loader.Set("user2", a.usercache.Get("user1"))
+        self.assertTrue("group:author" in a.Principals("user2", self.request))
+
+        root.DeleteUser(str(o1))
+        root.DeleteUser(str(o2))
+
+
+    def test_principals(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups=("group:author",), currentUser=user)
+
+        @implementer(ILocalGroups)
+        class Context(object):
+            calls = 0
+            def GetLocalGroups(self, userid, user=None):
+                self.calls += 1
+                return ("group:owner", "group:author")
+
+        self.request.environ.pop("authenticated_user", None)
+        c1, c2 = Context(), Context()
+        p = a.Principals("user1", self.request, c1)
+        self.assertTrue(p==("group:author", "group:owner"), p)
+        for i in range(5):
+            self.assertTrue(a.Principals("user1", self.request, c1) is p)
+            a.Principals("user1", self.request, c2)
+        self.assertTrue(c1.calls==1 and c2.calls==1)
+        self.assertTrue(a.Principals("user1", self.request)==("group:author",))
+        self.assertTrue(a.Principals("user1", None, c1)==p)
+        self.assertTrue(c1.calls==2)
+
+        # group changes reset the memoized principals
+        loader = GetUserLoader(self.request, a)
+        self.assertTrue(loader.principals)
+        o.UpdateGroups(["group:editor"])
+        o.Commit(user)
+        self.assertFalse(loader.principals)
+
+        root.DeleteUser(str(o))
+
+
+    def _countQueries(self):
+        # counts sql statements executed by the current connection
+        conn = self.app.db.connection.cursor().connection
+        if not hasattr(conn, "set_trace_callback"):
+            self.skipTest("statement tracing not supported")
+        statements = []
+        conn.set_trace_callback(statements.append)
+        return statements, lambda: conn.set_trace_callback(None)
+
+    def test_indexes(self):
+        a=self.app
+        tool = a.GetTool("nive_userdb.tools.dbIndexUpdater")
+        stream, result = tool(create=False)
+        self.assertTrue(result, stream.getvalue())
+        indexes = GetIndexes(a)
+        self.assertTrue("users_emailnorm" in [i.id for i in indexes])
+        connection = a.NewConnection()
+        db = connection.GetDBManager()
+        report = UpdateIndexes(db, indexes, create=False)
+        connection.close()
+        self.assertTrue([s for i, s in report]==["exists"]*len(indexes), report)
+
+    def test_normalized(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "User1"
+        data["email"] = "User1@AAA.ccc "
+        o1,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+        self.assertTrue(o1, r)
+        self.assertTrue(o1.data.namenorm=="user1")
+        self.assertTrue(o1.data.emailnorm=="user1@aaa.ccc")
+        self.assertTrue(root.GetUserByMail("user1@aaa.ccc").id==o1.id)
+        self.assertTrue(root.GetUserByName("USER1").id==o1.id)
+        self.assertTrue(root.FindUserIDs("user1@AAA.ccc", ("email",))==(o1.id,))
+        data["name"] = "user1"
+        data["email"] = "user1@bbb.ccc"
+        o2,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+        self.assertFalse(o2)
+
+        # rows not normalized yet are matched exactly
+        a.db.Execute("update users set namenorm='', emailnorm=''").close()
+        a.db.Commit()
+        self.assertTrue(root.IdentitiesNormalized())
+        a.userlookup = None
+        self.assertFalse(root.IdentitiesNormalized())
+        self.assertFalse(root.GetUserByName("user1"))
+        self.assertTrue(root.GetUserByName("User1").id==o1.id)
+        self.assertTrue(root.FindUserIDs("User1", ("name",))==(o1.id,))
+        # backfill existing rows
+        checked, updated = NormalizeUsers(a, batch=1)
+        self.assertTrue(updated==1, (checked, updated))
+        self.assertTrue(root.GetUserByName("user1").id==o1.id)
+        self.assertTrue(root.IdentitiesNormalized())
+        self.assertTrue(NormalizeUsers(a)[1]==0)
+        self.assertFalse(NormalizedCollisions(a))
+        a.db.Execute("update users set namenorm='', emailnorm=''").close()
+        a.db.Commit()
+        a.userlookup = None
+        self.assertTrue(root.Login("User1", "11111", raiseUnauthorized=0)[0])
+        # commits fill the normalized columns
+        self.assertTrue(NormalizeUsers(a)[1]==0)
+
+        # names only differing in case are reported
+        data["name"] = "user1b"
+        data["email"] = "user1b@aaa.ccc"
+        o2,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+        a.db.Execute("update users set name='USER1', namenorm='' where id=%d" % o2.dbEntry.GetDataRef()).close()
+        a.db.Commit()
+        NormalizeUsers(a)
+        self.assertTrue(NormalizedCollisions(a)==[("name", "user1", (o1.id, o2.id))], NormalizedCollisions(a))
+        self.assertTrue(root.GetUserByName("User1").id==o1.id)
+        self.assertTrue(root.GetUserByName("USER1").id==o2.id)
+        root.DeleteUser(str(o2.id))
+
+    def test_lookup_queries(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        root.DeleteUser(str(root.GetUserByName("user2", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o1,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+        data["name"] = "user2"
+        data["email"] = "user2@aaa.ccc"
+        o2,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+
+        statements, stop = self._countQueries()
+        u = root.LookupUser(name="user1")
+        self.assertTrue(u.id==o1.id)
+        self.assertTrue(u.data.email=="user1@aaa.ccc")
+        self.assertTrue(u.meta.pool_state==1)
+        self.assertTrue(len(statements)==1, statements)
+
+        del statements[:]
+        u = root.LookupUser(name="user2@aaa.ccc")
+        self.assertTrue(u.id==o2.id)
+        self.assertTrue(len(statements)==1, statements)
+
+        del statements[:]
+        self.assertTrue(root.LookupUser(email="user2").id==o2.id)
+        self.assertTrue(root.LookupUser(ident="user1").id==o1.id)
+        self.assertFalse(root.LookupUser(name="unknown"))
+        self.assertFalse(root.LookupUser(ident="user1@aaa.ccc"))
+        # unknown names are not matched exactly once all rows are normalized
+        self.assertTrue(len(statements)==4, statements)
+        stop()
+
+        # loaded users are signalled like Container.GetObj()
+        loaded = []
+        def onload(context):
+            loaded.append(context)
+        root.ListenEvent("loadObj", onload)
+        try:
+            root.LookupUser(name="user1")
+            root.LookupUser(name="unknown")
+        finally:
+            root.RemoveListener("loadObj", onload)
+        self.assertTrue(loaded==[root], loaded)
+
+        # name matches take precedence over email matches
+        o2.data["email"] = "user1"
+        o2.Commit(user)
+        self.assertTrue(root.LookupUser(name="user1").id==o1.id)
+        o1.data["email"] = "user2"
+        o1.Commit(user)
+        self.assertTrue(root.LookupUser(email="user2").id==o1.id)
+        # inactive users
+        o1.DeActivate(user)
+        self.assertTrue(root.LookupUser(name="user1").id==o2.id)
+        self.assertTrue(root.LookupUser(name="user1", activeOnly=0).id==o1.id)
+
+        root.DeleteUser(str(o1))
+        root.DeleteUser(str(o2))
+
+
+    def test_missing_user(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        root.DeleteUser(str(root.GetUserByMail("user1@aaa.ccc", activeOnly=0)))
+        a.usermisses.Clear()
+
+        lookups = []
+        lookup = root.LookupUser
+        def counter(**kw):
+            lookups.append(kw)
+            return lookup(**kw)
+        root.LookupUser = counter
+        try:
+            self.assertFalse(root.GetUser("user1"))
+            self.assertFalse(root.GetUser("user1"))
+            self.assertTrue(len(lookups)==1)
+
+            data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+            data["name"] = "user1"
+            data["email"] = "user1@aaa.ccc"
+            o,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+            self.assertTrue(o,r)
+            count = len(lookups)
+            self.assertTrue(root.GetUser("user1"))
+            self.assertTrue(len(lookups)==count+1)
+        finally:
+            del root.LookupUser
+
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+
+
     def test_reserved(self):
         self.assertTrue(IsReservedUserName(""))
         self.assertTrue(IsReservedUserName(None))
@@ -319,7 +736,7 @@ class ObjectTest_db(object):
         self.assertTrue(o,r)
 
         root.MailResetPass("user1@aaa.ccc", currentUser=user, url="")
-        self.assertTrue(root.GetUserByName("user1").data.token)
+        self.assertTrue([p for p, e in root.GetTokenStore().GetTokens(o.id)]==["reset"])
         o,r = root.MailResetPass("no mail", currentUser=user, url="")
         self.assertFalse(o,r)
 
@@ -346,6 +763,58 @@ class ObjectTest_db(object):
         root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
 
 
+    def test_tokens(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        root.DeleteUser(str(root.GetUserByName("user2", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o1,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups="", currentUser=user)
+        data["name"] = "user2"
+        data["email"] = "user2@aaa.ccc"
+        o2,r = root.AddUser(data, activate=0, generatePW=0, mail=None, groups="", currentUser=user)
+        store = root.GetTokenStore()
+        # activation tokens only for inactive accounts
+        self.assertFalse(store.GetTokens(o1.id))
+        self.assertTrue([p for p, e in store.GetTokens(o2.id)]==["activate"])
+        self.assertFalse(o2.data.token)
+
+        token = store.Create(o1.id, "reset")
+        self.assertTrue(len(token)==32)
+        self.assertTrue(store.Lookup(token)==o1.id)
+        self.assertTrue(root.GetUserForToken(token, purpose="reset").id==o1.id)
+        self.assertFalse(root.GetUserForToken(token, purpose="verifymail"))
+        # a new token replaces the previous one
+        token2 = store.Create(o1.id, "reset")
+        self.assertFalse(store.Lookup(token))
+        self.assertTrue(store.Lookup(token2)==o1.id)
+        o1.UpdatePassword("22222", user)
+        self.assertFalse(store.Lookup(token2))
+
+        # legacy tokens stored in the user record only activate inactive accounts
+        o2.data["token"] = "legacy2"
+        o2.Commit(user)
+        o1.data["token"] = "legacy1"
+        o1.Commit(user)
+        self.assertTrue(root.GetUserForToken("legacy2", activeOnly=False).id==o2.id)
+        self.assertTrue(root.GetUserForToken("legacy2", activeOnly=False, purpose="activate").id==o2.id)
+        self.assertFalse(root.GetUserForToken("legacy2", activeOnly=False, purpose="reset"))
+        self.assertFalse(root.GetUserForToken("legacy1", activeOnly=False))
+        self.assertFalse(root.GetUserForToken("legacy1", purpose="reset"))
+
+        # expiry and purge
+        expired = store.Create(o1.id, "verifymail", expires=-10)
+        self.assertFalse(root.GetUserForToken(expired))
+        self.assertTrue(store.Purge(batch=1)==1)
+        self.assertTrue(store.Purge()==0)
+        self.assertTrue(len(store.GetTokens(o2.id))==1)
+        root.DeleteUser("user2")
+        self.assertFalse(store.GetTokens(o2.id))
+
+
     def test_groups(self):
         a=self.app
         root=a.root
@@ -373,6 +842,56 @@ class ObjectTest_db(object):
         self.assertTrue(o.InGroups(("g1","g2","g3")))
 
 
+    def test_group_relation(self):
+        a=self.app
+        root=a.root
+        user = User("test")
+        root.DeleteUser(str(root.GetUserByName("user1", activeOnly=0)))
+        root.DeleteUser(str(root.GetUserByName("user2", activeOnly=0)))
+        data = {"password": "11111", "surname": "surname", "lastname": "lastname"}
+        data["name"] = "user1"
+        data["email"] = "user1@aaa.ccc"
+        o1,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups=("group:editor",), currentUser=user)
+        data["name"] = "user2"
+        data["email"] = "user2@aaa.ccc"
+        o2,r = root.AddUser(data, activate=1, generatePW=0, mail=None, groups=("group:edit",), currentUser=user)
+
+        # exact match only
+        users = root.GetUsersWithGroup("group:edit", fields=["name"])
+        self.assertTrue([u["name"] for u in users]==["user2"], users)
+        users = root.GetUsersWithGroup(["group:edit", "group:editor"], fields=["name"])
+        self.assertTrue(sorted([u["name"] for u in users])==["user1", "user2"], users)
+
+        o2.UpdateGroups(["group:author"])
+        o2.Commit(user)
+        self.assertFalse(root.GetUsersWithGroup("group:edit", fields=["name"]))
+        self.assertTrue(len(root.GetUsersWithGroup("group:author", fields=["name"]))==1)
+
+        # failed commits do not change the relation
+        def fail(user=None):
+            raise ValueError("commit failed")
+        o1.dbEntry.Commit = fail
+        o1.UpdateGroups(["group:admin"])
+        self.assertRaises(ValueError, o1.Commit, user)
+        del o1.dbEntry.Commit
+        o2.data["surname"] = "other"
+        o2.Commit(user)
+        self.assertFalse(root.GetUsersWithGroup("group:admin", fields=["name"]))
+
+        # backfill
+        a.db.Execute("DELETE FROM users_groups").close()
+        a.db.Commit()
+        self.assertFalse(root.GetUsersWithGroup("group:editor", fields=["name"]))
+        users, assignments = SyncUserGroups(a, batch=1)
+        self.assertTrue(users>=2 and assignments>=2)
+        self.assertTrue(len(root.GetUsersWithGroup("group:editor", fields=["name"]))==1)
+
+        root.DeleteUser("user1")
+        root.DeleteUser("user2")
+        self.assertFalse(root.GetUsersWithGroup("group:editor", fields=["name"]))
+        self.assertFalse(root.GetUsersWithGroup("group:author", fields=["name"]))
+
+
 
 
 
@@ -425,4 +944,37 @@ class AdminuserTest_db(__local.DefaultTestCase):
         l,r = root.Login("admin", "", raiseUnauthorized = 0)
         self.assertFalse(l,r)
 
+    def test_userloader(self):
+        a=self.app
+        # the admin user is resolved in batches
+        users = UserLoader(a).GetMany(["admin", "unknown1", "unknown2"])
+        self.assertTrue(IAdminUser.providedBy(users[0]) and users[0].identity=="admin")
+        self.assertTrue(users[1:]==[None, None])
+        self.assertTrue(IAdminUser.providedBy(UserLoader(a).Get("admin")))
+
+    def test_lookup(self):
+        a=self.app
+        root=a.root
+        lookup = root.GetUserLookup()
+        self.assertTrue(lookup is root.GetUserLookup())
+        self.assertTrue(IAdminUser.providedBy(root.LookupUser(name="admin")))
+        self.assertTrue(IAdminUser.providedBy(root.LookupUser(email="admin@aaa.ccc")))
+        self.assertTrue(IAdminUser.providedBy(root.LookupUser(ident="admin")))
+        self.assertTrue(root.LookupUser(ident="admin").identity=="admin")
+        self.assertFalse(root.LookupUser(email="admin"))
+
+        # recompiled for a different identity field
+        root.identityField = "email"
+        self.assertTrue(root.GetUserLookup() is not lookup)
+        self.assertTrue(root.LookupUser(ident="admin@aaa.ccc").identity=="admin@aaa.ccc")
+        root.identityField = "name"
+
+        # email login disabled
+        a.configuration.unlock()
+        a.configuration.loginByEmail = False
+        a.configuration.lock()
+        ResetUserLookup(a, None)
+        self.assertFalse(root.LookupUser(email="admin@aaa.ccc"))
+        self.assertTrue(IAdminUser.providedBy(root.LookupUser(name="admin")))
+
 
@@ -0,0 +1,154 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+User tokens
+-----------
+Tokens for account activation, password reset and email verification are stored hashed
+in a separate table with the user id, a purpose and an expiry timestamp. Only the token
+hash is stored. The plain token is returned once on creation and passed to the mail
+template as `token`.
+
+Lookups are point queries on the hash. Expired tokens are removed by `TokenStore.Purge()`
+in batches, e.g. run `nive_userdb.tools.purgeTokens` periodically.
+
+Token lifetimes in seconds are configured by purpose ::
+
+    configuration.tokenExpires = {"activate": 60*60*24*30, "reset": 60*60*24, "verifymail": 60*60*24*7}
+
+The table is created by `nive.tools.dbStructureUpdater`.
+"""
+
+import hashlib
+import time
+import uuid
+
+from nive.definitions import Structure, FieldConf
+
+from nive_userdb.i18n import _
+
+
+TokenTbl = "users_tokens"
+
+Structure[TokenTbl] = {"identity": None,
+                       "fields": (
+    FieldConf(id="tokenkey", datatype="string",  size=64,  default="",  required=1, readonly=1, name=_("Token hash")),
+    FieldConf(id="id",       datatype="number",  size=8,   default=0,   required=1, readonly=1, name=_("User ID")),
+    FieldConf(id="purpose",  datatype="string",  size=20,  default="",  required=1, readonly=1, name=_("Purpose")),
+    FieldConf(id="expires",  datatype="number",  size=8,   default=0,   required=0, readonly=1, name=_("Expires")),
+)}
+
+# default token lifetimes in seconds. 0 = never expires.
+DefaultExpires = {"activate": 60*60*24*30, "reset": 60*60*24, "verifymail": 60*60*24*7}
+
+
+def HashToken(token):
+    """
+    Returns the fixed size token hash stored in the database
+    """
+    if isinstance(token, str):
+        token = token.encode("utf-8")
+    return hashlib.sha256(token).hexdigest()
+
+
+class TokenStore(object):
+    """
+    Stores hashed user tokens with purpose and expiry. Tokens are created for a single user and
+    purpose. Creating a new token replaces existing tokens of the same purpose.
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.expires = dict(DefaultExpires)
+        self.expires.update(app.configuration.get("tokenExpires") or {})
+
+    def Create(self, userid, purpose, token=None, expires=None):
+        """
+        Creates and stores a new token. Existing tokens of the user with the same purpose
+        are removed. `expires` is the lifetime in seconds and defaults to the `tokenExpires`
+        setting for the purpose.
+        returns the plain token
+        """
+        if token is None:
+            token = str(uuid.uuid4()).replace("-","")
+        if expires is None:
+            expires = self.expires.get(purpose, 0)
+        expires = int(time.time()+expires) if expires else 0
+        db = self.app.db
+        ph = db.placeholder
+        cursor = db.Execute("DELETE FROM %s WHERE id = %s AND purpose = %s" % (TokenTbl, ph, ph), (userid, purpose))
+        db.Execute("INSERT INTO %s (tokenkey, id, purpose, expires) VALUES (%s,%s,%s,%s)" % (TokenTbl, ph, ph, ph, ph),
+                   (HashToken(token), userid, purpose, expires), cursor=cursor)
+        cursor.close()
+        db.Commit()
+        return token
+
+    def Lookup(self, token, purpose=None):
+        """
+        Returns the user id for the token or None if the token does not exist, is expired or
+        has a different purpose.
+        """
+        if not token:
+            return None
+        db = self.app.db
+        ph = db.placeholder
+        cursor = db.Execute("SELECT id, purpose, expires FROM %s WHERE tokenkey = %s" % (TokenTbl, ph), (HashToken(token),))
+        records = cursor.fetchall()
+        cursor.close()
+        if len(records) != 1:
+            return None
+        userid, tokenpurpose, expires = records[0]
+        if purpose and purpose != tokenpurpose:
+            return None
+        if expires and expires < time.time():
+            return None
+        return userid
+
+    def GetTokens(self, userid):
+        """
+        Returns the users tokens as list of (purpose, expires)
+        """
+        db = self.app.db
+        cursor = db.Execute("SELECT purpose, expires FROM %s WHERE id = %s" % (TokenTbl, db.placeholder), (userid,))
+        records = cursor.fetchall()
+        cursor.close()
+        return [tuple(r) for r in records]
+
+    def Remove(self, userid, purpose=None):
+        """
+        Removes the users tokens. All tokens if `purpose` is None.
+        """
+        db = self.app.db
+        ph = db.placeholder
+        if purpose:
+            cursor = db.Execute("DELETE FROM %s WHERE id = %s AND purpose = %s" % (TokenTbl, ph, ph), (userid, purpose))
+        else:
+            cursor = db.Execute("DELETE FROM %s WHERE id = %s" % (TokenTbl, ph), (userid,))
+        cursor.close()
+        db.Commit()
+
+    def Purge(self, batch=1000):
+        """
+        Deletes expired tokens in batches. Each batch selects expired token hashes on the
+        expires index and deletes them by key.
+        returns the number of deleted tokens
+        """
+        db = self.app.db
+        ph = db.placeholder
+        now = int(time.time())
+        select = "SELECT tokenkey FROM %s WHERE expires > 0 AND expires < %s LIMIT %d" % (TokenTbl, ph, batch)
+        deleted = 0
+        while True:
+            cursor = db.Execute(select, (now,))
+            keys = [r[0] for r in cursor.fetchall()]
+            cursor.close()
+            if not keys:
+                break
+            cursor = db.Execute("DELETE FROM %s WHERE tokenkey IN (%s)" % (TokenTbl, ",".join([ph]*len(keys))), keys)
+            cursor.close()
+            db.Commit()
+            deleted += len(keys)
+            if len(keys) < batch:
+                break
+        return deleted
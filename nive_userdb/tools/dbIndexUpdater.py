@@ -0,0 +1,165 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+Database indexes
+----------------
+Creates or verifies the database indexes declared as `indexes` by object configurations
+and the application configuration. Run the tool after `nive.tools.dbStructureUpdater` ::
+
+    app.GetTool("nive.tools.dbStructureUpdater")()
+    app.GetTool("nive_userdb.tools.dbIndexUpdater")()
+
+Indexes are declared as ::
+
+    configuration.indexes = (Conf(id="users_name", table="users", columns=("name",)),)
+
+Set `unique=True` to create a unique index.
+
+Supports Sqlite3, MySql and PostgreSql. Existing indexes are checked by name and never changed.
+"""
+
+from nive.tool import Tool, ToolView
+from nive.definitions import ToolConf, ViewConf, FieldConf, IApplication
+from nive.utils.dataPool2.base import OperationalError
+
+from nive_userdb.i18n import _
+
+
+configuration = ToolConf(
+    id = "dbIndexUpdater",
+    context = "nive_userdb.tools.dbIndexUpdater.dbIndexUpdater",
+    name = _("Database Indexes"),
+    description = _("Create or verify the database indexes for configured lookup columns."),
+    apply = (IApplication,),
+    mimetype = "text/html",
+    data = [
+        FieldConf(id="create", datatype="bool", default=1, name=_("Create missing indexes"), description=""),
+    ],
+    views = [
+        ViewConf(name="", view=ToolView, attr="run", permission="system", context="nive_userdb.tools.dbIndexUpdater.dbIndexUpdater")
+    ]
+)
+
+
+class dbIndexUpdater(Tool):
+
+    def _Run(self, **values):
+        create = values.get("create")
+        self.InitStream()
+        app = self.app
+        try:
+            connection = app.NewConnection()
+        except OperationalError:
+            connection = None
+        if not connection:
+            self.stream.write("""<div class="alert alert-danger">No database connection configured</div>""")
+            return self.stream, 0
+        db = connection.GetDBManager()
+        try:
+            db.UseDatabase(app.dbConfiguration.get("dbName"))
+            report = UpdateIndexes(db, GetIndexes(app), create=create)
+        finally:
+            connection.close()
+
+        result = 1
+        self.stream.write("""<table class="table"><tbody>\n""")
+        for index, status in report:
+            if status in ("failed", "missing"):
+                result = 0
+            self.stream.write("<tr><td>%s</td><td>%s(%s)</td><td>%s</td></tr>\n" % (
+                              index.id, index.table, ", ".join(index.columns), status))
+        self.stream.write("""</tbody></table>\n""")
+        return self.stream, result
+
+
+def GetIndexes(app):
+    """
+    Collects the `indexes` of all object configurations and the application configuration.
+    Tables listed in `skipUpdateTables` are ignored.
+    """
+    ignoreTables = app.configuration.get("skipUpdateTables", ())
+    indexes = []
+    for conf in app.configurationQuery.GetAllObjectConfs():
+        indexes.extend(conf.get("indexes") or ())
+    indexes.extend(app.configuration.get("indexes") or ())
+    unique = {}
+    for index in indexes:
+        if index.table in ignoreTables:
+            continue
+        unique.setdefault(index.id, index)
+    return list(unique.values())
+
+
+def UpdateIndexes(db, indexes, create=True):
+    """
+    Creates missing indexes. `db` is the database manager of a new connection.
+    returns a list of (index, status). status is one of exists, created, missing, failed
+    """
+    dialect = IndexDialect(db)
+    report = []
+    for index in indexes:
+        try:
+            if dialect.IsIndex(index):
+                status = "exists"
+            elif not create:
+                status = "missing"
+            else:
+                dialect.CreateIndex(index)
+                status = "created"
+        except Exception:
+            db.dbConn.rollback()
+            status = "failed"
+        report.append((index, status))
+    db.dbConn.commit()
+    return report
+
+
+def IndexDialect(db):
+    """
+    Returns the index statements for the database manager
+    """
+    name = db.__class__.__name__
+    if name.startswith("MySql"):
+        return MySqlIndexes(db)
+    if name.startswith("Postgres"):
+        return PostgreSqlIndexes(db)
+    return SqliteIndexes(db)
+
+
+class SqliteIndexes(object):
+    check = "SELECT name FROM sqlite_master WHERE type='index' AND tbl_name=? AND name=?"
+    create = "CREATE %sINDEX IF NOT EXISTS %s ON %s (%s)"
+
+    def __init__(self, db):
+        self.db = db
+
+    def IsIndex(self, index):
+        cursor = self.db.dbConn.cursor()
+        cursor.execute(self.check, (index.table, index.id))
+        r = cursor.fetchall()
+        cursor.close()
+        return len(r)>0
+
+    def CreateIndex(self, index):
+        cursor = self.db.dbConn.cursor()
+        unique = "UNIQUE " if index.get("unique") else ""
+        cursor.execute(self.create % (unique, index.id, index.table, ", ".join(index.columns)))
+        cursor.close()
+
+
+class PostgreSqlIndexes(SqliteIndexes):
+    check = "SELECT indexname FROM pg_indexes WHERE tablename=%s AND indexname=%s"
+
+
+class MySqlIndexes(SqliteIndexes):
+    check = "SHOW INDEX FROM %s WHERE Key_name=%%s"
+    create = "CREATE %sINDEX %s ON %s (%s)"
+
+    def IsIndex(self, index):
+        cursor = self.db.dbConn.cursor()
+        cursor.execute(self.check % index.table, (index.id,))
+        r = cursor.fetchall()
+        cursor.close()
+        return len(r)>0
@@ -0,0 +1,119 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+Normalized identities
+---------------------
+Fills the normalized shadow columns `namenorm` and `emailnorm` of existing users. Users are
+read in batches ordered by id and only changed rows are updated. Run the tool once after
+`nive.tools.dbStructureUpdater` created the columns ::
+
+    app.GetTool("nive_userdb.tools.normalizeIdentities")()
+
+Until then lookups missing the normalized columns are repeated as exact matches on the
+original columns. Each process checks once if all rows are normalized. The tool reports users
+whose names or emails only differ in case. These users can only sign in with the exact name
+or email and should be renamed.
+"""
+
+from nive.tool import Tool, ToolView
+from nive.definitions import ToolConf, ViewConf, FieldConf, IApplication, MetaTbl
+
+from nive_userdb.i18n import _
+from nive_userdb.app import NormalizedFields, NormalizeIdentity
+
+
+configuration = ToolConf(
+    id = "normalizeIdentities",
+    context = "nive_userdb.tools.normalizeIdentities.normalizeIdentities",
+    name = _("Normalize user names and emails"),
+    description = _("Fill the normalized name and email columns used for case insensitive lookups."),
+    apply = (IApplication,),
+    mimetype = "text/html",
+    data = [
+        FieldConf(id="batch", datatype="number", default=1000, name=_("Batch size"), description=""),
+    ],
+    views = [
+        ViewConf(name="", view=ToolView, attr="run", permission="system", context="nive_userdb.tools.normalizeIdentities.normalizeIdentities")
+    ]
+)
+
+
+class normalizeIdentities(Tool):
+
+    def _Run(self, **values):
+        self.InitStream()
+        batch = int(values.get("batch") or 1000)
+        checked, updated = NormalizeUsers(self.app, batch=batch)
+        self.stream.write(_("${checked} users checked, ${updated} updated", mapping={"checked": checked, "updated": updated}))
+        collisions = NormalizedCollisions(self.app)
+        for field, value, ids in collisions:
+            self.stream.write("<br>")
+            self.stream.write(_("Duplicate ${field} '${value}': users ${ids}", 
+                                mapping={"field": field, "value": value, "ids": ", ".join([str(i) for i in ids])}))
+        return self.stream, 1
+
+
+def NormalizeUsers(app, batch=1000):
+    """
+    Updates the normalized columns of all users in batches. Each batch is committed.
+    returns the number of checked and updated users
+    """
+    db = app.db
+    conf = app.configurationQuery.GetObjectConf("user", skipRoot=True)
+    table = conf.dbparam
+    fields = [f.id for f in conf.data]
+    columns = [(field, norm) for field, norm in sorted(NormalizedFields.items()) if norm in fields]
+    if not columns:
+        return 0, 0
+    ph = db.placeholder
+    select = "SELECT id,%s FROM %s WHERE id > %s ORDER BY id LIMIT %d" % (
+             ",".join([f for c in columns for f in c]), table, ph, batch)
+    update = "UPDATE %s SET %s WHERE id = %s" % (
+             table, ",".join(["%s = %s" % (norm, ph) for field, norm in columns]), ph)
+    checked = updated = 0
+    last = 0
+    while True:
+        records = db.Query(select, [last])
+        if not records:
+            break
+        changes = []
+        for r in records:
+            values = [NormalizeIdentity(r[1+i*2]) for i in range(len(columns))]
+            if values != [r[2+i*2] for i in range(len(columns))]:
+                changes.append(values + [r[0]])
+        if changes:
+            cursor = db.connection.cursor()
+            cursor.executemany(update, changes)
+            cursor.close()
+            db.Commit()
+        checked += len(records)
+        updated += len(changes)
+        last = records[-1][0]
+    # lookups check again if exact fallbacks are required
+    lookup = getattr(app, "userlookup", None)
+    if lookup is not None:
+        lookup.backfilled = None
+    return checked, updated
+
+
+def NormalizedCollisions(app):
+    """
+    Returns users with the same normalized name or email, e.g. "Foo" and "foo".
+    returns list of (field, normalized value, user ids)
+    """
+    db = app.db
+    conf = app.configurationQuery.GetObjectConf("user", skipRoot=True)
+    table = conf.dbparam
+    fields = [f.id for f in conf.data]
+    collisions = []
+    for field, norm in sorted(NormalizedFields.items()):
+        if norm not in fields:
+            continue
+        sql = "SELECT %s FROM %s WHERE %s <> '' GROUP BY %s HAVING COUNT(*) > 1 ORDER BY %s" % (norm, table, norm, norm, norm)
+        for r in db.Query(sql, []):
+            ids = db.Query("""SELECT meta__.id FROM %s AS meta__ INNER JOIN %s AS data__ ON (meta__.pool_dataref = data__.id)
+                              WHERE meta__.pool_type = 'user' AND data__.%s = %s ORDER BY meta__.id""" % (MetaTbl, table, norm, db.placeholder), [r[0]])
+            collisions.append((field, r[0], tuple([i[0] for i in ids])))
+    return collisions
@@ -0,0 +1,45 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+Purge expired tokens
+--------------------
+Deletes expired activation, password reset and email verification tokens in batches. Run
+the tool periodically ::
+
+    app.GetTool("nive_userdb.tools.purgeTokens")()
+
+"""
+
+from nive.tool import Tool, ToolView
+from nive.definitions import ToolConf, ViewConf, FieldConf, IApplication
+
+from nive_userdb.i18n import _
+from nive_userdb.tokens import TokenStore
+
+
+configuration = ToolConf(
+    id = "purgeTokens",
+    context = "nive_userdb.tools.purgeTokens.purgeTokens",
+    name = _("Purge expired tokens"),
+    description = _("Delete expired activation, password reset and email verification tokens."),
+    apply = (IApplication,),
+    mimetype = "text/html",
+    data = [
+        FieldConf(id="batch", datatype="number", default=1000, name=_("Batch size"), description=""),
+    ],
+    views = [
+        ViewConf(name="", view=ToolView, attr="run", permission="system", context="nive_userdb.tools.purgeTokens.purgeTokens")
+    ]
+)
+
+
+class purgeTokens(Tool):
+
+    def _Run(self, **values):
+        self.InitStream()
+        batch = int(values.get("batch") or 1000)
+        deleted = TokenStore(self.app).Purge(batch=batch)
+        self.stream.write(_("${deleted} expired tokens deleted", mapping={"deleted": deleted}))
+        return self.stream, 1
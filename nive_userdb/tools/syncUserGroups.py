@@ -0,0 +1,46 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+Sync user groups
+----------------
+Rebuilds the user group relation table `users_groups` from the users `groups` field. Users
+are read in batches ordered by id. Run the tool once after `nive.tools.dbStructureUpdater`
+created the table ::
+
+    app.GetTool("nive_userdb.tools.syncUserGroups")()
+
+"""
+
+from nive.tool import Tool, ToolView
+from nive.definitions import ToolConf, ViewConf, FieldConf, IApplication
+
+from nive_userdb.i18n import _
+from nive_userdb.usergroups import SyncUserGroups
+
+
+configuration = ToolConf(
+    id = "syncUserGroups",
+    context = "nive_userdb.tools.syncUserGroups.syncUserGroups",
+    name = _("Sync user groups"),
+    description = _("Rebuild the user group relation table from the users groups field."),
+    apply = (IApplication,),
+    mimetype = "text/html",
+    data = [
+        FieldConf(id="batch", datatype="number", default=1000, name=_("Batch size"), description=""),
+    ],
+    views = [
+        ViewConf(name="", view=ToolView, attr="run", permission="system", context="nive_userdb.tools.syncUserGroups.syncUserGroups")
+    ]
+)
+
+
+class syncUserGroups(Tool):
+
+    def _Run(self, **values):
+        self.InitStream()
+        batch = int(values.get("batch") or 1000)
+        users, assignments = SyncUserGroups(self.app, batch=batch)
+        self.stream.write(_("${users} users checked, ${assignments} group assignments stored", mapping={"users": users, "assignments": assignments}))
+        return self.stream, 1
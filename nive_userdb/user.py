@@ -7,6 +7,9 @@ import AuthEncoding
 from datetime import datetime
 
 from nive_userdb.i18n import _
+from nive_userdb.app import NormalizedFields, NormalizeIdentity
+from nive_userdb.usergroups import SetUserGroups, RemoveUserGroups
+from nive_userdb.userloader import InvalidateRequestUser
 from nive.definitions import implementer, IUser
 
 from nive.objects import Object
@@ -33,16 +36,67 @@ class Userobject(Object):
     def Init(self):
         self.previousLogin = None
         self.groups = tuple(self.data.get("groups",()))
+        self.groupset = frozenset(self.groups)
         self.ListenEvent("commit", "OnCommit")
+        self.ListenEvent("committed", "OnCommitted")
+        self.ListenEvent("delete", "OnDelete")
+
+
+    def CommitInternal(self, user):
+        """
+        Commit changes made to data, meta and files attributes without calling wf.
+        Handlers depending on stored values listen to `committed`, which is only signalled
+        if the database commit succeeded.
+
+        Event: 
+        - commit(user) before the database commit
+        - committed(user, changed) after the database commit. `changed` are the stored fields.
+        """
+        self.Signal("commit", user=user)
+        changed = frozenset(self.data.GetTemp()) | frozenset(self.meta.GetTemp())
+        self.dbEntry.Commit(user=user)
+        self.Signal("committed", user=user, changed=changed)
 
 
     def OnCommit(self, **kw):
         self.HashPassword()
+        self.UpdateNormalized()
         t = self.ReadableName()
         if t != self.meta["title"]:
             self.meta["title"] = t
 
 
+    def OnCommitted(self, changed=(), **kw):
+        if "groups" in changed:
+            # keep the group relation table in sync with the stored groups
+            db = self.app.db
+            try:
+                SetUserGroups(db, self.id, self.data.get("groups"))
+                db.Commit()
+            except:
+                db.Undo()
+                raise
+            InvalidateRequestUser(self.app, self.identity)
+
+
+    def OnDelete(self, **kw):
+        RemoveUserGroups(self.app.db, self.id)
+        InvalidateRequestUser(self.app, self.identity)
+
+
+    def UpdateNormalized(self):
+        """
+        Updates the normalized shadow columns used for case insensitive name and email lookups
+        """
+        fields = [f.id for f in self.configuration.data]
+        for field, norm in NormalizedFields.items():
+            if norm not in fields:
+                continue
+            value = NormalizeIdentity(self.data.get(field))
+            if value != self.data.get(norm):
+                self.data[norm] = value
+
+
     def Authenticate(self, password):
         if not password:
             return False
@@ -71,6 +125,7 @@ class Userobject(Object):
         if result:
             self.Signal("activate")
             self.Commit(currentUser)
+            self.parent.GetTokenStore().Remove(self.id, "activate")
         return result
 
 
@@ -153,6 +208,8 @@ class Userobject(Object):
         if resetActivation:
             self.data["token"] = ""
         self.Commit(user)
+        if resetActivation:
+            self.parent.GetTokenStore().Remove(self.id)
         return True
 
 
@@ -165,6 +222,8 @@ class Userobject(Object):
         if resetActivation:
             self.data["token"] = ""
         self.Commit(user)
+        if resetActivation:
+            self.parent.GetTokenStore().Remove(self.id)
         return True
 
 
@@ -173,6 +232,7 @@ class Userobject(Object):
         update groups of user
         """
         self.groups = tuple(groups)
+        self.groupset = frozenset(self.groups)
         self.data["groups"] = self.groups
         return True
 
@@ -189,6 +249,7 @@ class Userobject(Object):
         g = list(self.groups)
         g.append(group)
         self.groups = tuple(g)
+        self.groupset = frozenset(self.groups)
         self.data["groups"] = g
         return True
 
@@ -204,6 +265,7 @@ class Userobject(Object):
         g = list(self.groups)
         g.remove(group)
         self.groups = tuple(g)
+        self.groupset = frozenset(self.groups)
         self.data["groups"] = g
         return True
 
@@ -221,16 +283,18 @@ class Userobject(Object):
         check if user has one of these groups
         """
         if isinstance(groups, str):
-            return groups in self.groups
+            return groups in self.groupset
         for g in groups:
-            if g in self.groups:
+            if g in self.groupset:
                 return True
         return False
 
 
 # user definition ------------------------------------------------------------------
-from nive.definitions import ObjectConf, FieldConf
+from nive.definitions import ObjectConf, FieldConf, Conf, MetaTbl
 from nive_userdb.app import UsernameValidator, EmailValidator, PasswordValidator, StagUser
+from nive_userdb.tokens import TokenTbl
+from nive_userdb.usergroups import UserGroupsTbl
 
 #@nive_module
 configuration = ObjectConf(
@@ -258,6 +322,8 @@ system = [
     FieldConf(id="lastlogin",datatype="datetime",    size=0,   default="", name=_("Last login"), description=""),
     FieldConf(id="token",    datatype="string",      size=30,  default="", name=_("Token for activation or password reset")),
     FieldConf(id="tempcache",datatype="string",      size=255, default="", name=_("Temp cache for additional verification data")),
+    FieldConf(id="namenorm", datatype="string",      size= 40, default="", name=_("Normalized user ID for lookups")),
+    FieldConf(id="emailnorm",datatype="string",      size=255, default="", name=_("Normalized email for lookups")),
 ]
 extended = [
     FieldConf(id="surname",  datatype="string",      size=100, default="", name=_("Surname"), description=""),
@@ -272,3 +338,20 @@ configuration.forms = {
                           FieldConf(id="password", name=_("Password"), datatype="password", required=False, settings={"update": True}),
                           "surname", "lastname", "organisation"]},
 }
+
+# database indexes for user lookups. created or verified by nive_userdb.tools.dbIndexUpdater.
+# users are selected by joining pool_meta on pool_dataref. the state filter is part of the
+# meta index because pool_state is stored in pool_meta.
+configuration.indexes = (
+    Conf(id="users_name",      table="users", columns=("name",)),
+    Conf(id="users_namenorm",  table="users", columns=("namenorm",)),
+    Conf(id="users_emailnorm", table="users", columns=("emailnorm",)),
+    Conf(id="users_token",     table="users", columns=("token",)),
+    Conf(id="users_tempcache", table="users", columns=("tempcache",)),
+    Conf(id="pool_meta_dataref_state", table=MetaTbl, columns=("pool_dataref", "pool_state")),
+    Conf(id="users_tokens_key",     table=TokenTbl, columns=("tokenkey",), unique=True),
+    Conf(id="users_tokens_user",    table=TokenTbl, columns=("id", "purpose")),
+    Conf(id="users_tokens_expires", table=TokenTbl, columns=("expires",)),
+    Conf(id="users_groups_group",   table=UserGroupsTbl, columns=("groupid", "userid")),
+    Conf(id="users_groups_user",    table=UserGroupsTbl, columns=("userid",)),
+)
@@ -49,6 +49,7 @@ configuration.views = [
 
 from nive.components.reform.forms import ObjectForm, HTMLForm
 from nive_userdb.app import UsernameValidator
+from nive_userdb.usergroups import GroupCondition
 
 from nive.components.adminview.view import AdminBasics
     
@@ -90,15 +91,22 @@ class UsermanagementView(AdminBasics):
         sort = self.EscapeSortField(self.configuration.listfields)
         asc = '1' if self.GetFormValue('ac', '1') == '1' else '0'
         start = self.GetFormValue('st', '0')
+        # groups are matched exactly on the user group relation table
+        parameter = dict(formvalues)
+        groups = parameter.pop("groups", None)
+        kw = {}
+        if groups:
+            kw["condition"], kw["extraValues"] = GroupCondition(self.context.app.db, groups)
         users = self.context.search.SearchType("user",
-                                               parameter=formvalues,
-                                               operators=dict(groups="LIKE",name="LIKE",email="LIKE"),
+                                               parameter=parameter,
+                                               operators=dict(name="LIKE",email="LIKE"),
                                                fields=listfields,
                                                sort=sort or "name",
                                                ascending=int(asc),
                                                start=start,
                                                max=100,
-                                               skipRender=())
+                                               skipRender=(),
+                                               **kw)
 
         searchvalues = dict(so=sort, st=start, ac=asc)
         return dict(formhtml=formhtml, formvalues=formvalues, fields=listfields, users=users, searchvalues=searchvalues)
@@ -144,19 +152,17 @@ class UsermanagementView(AdminBasics):
     def delete(self):
         ids = self.GetFormValue("ids")
         confirm = self.GetFormValue("confirm")
-        users = []
         msgs = []
         root = self.context.root
         if isinstance(ids, str):
             ids = (ids,)
         elif not ids:
             ids = ()
+        users = root.GetUsersByIDs(ids, activeOnly=0)
+        found = [str(u.id) for u in users]
         for i in ids:
-            u = root.GetUserByID(i, activeOnly=0)
-            if not u:
+            if not str(i) in found:
                 msgs.append(self.Translate(_("User not found. (id %(name)s)", mapping={"name": i})))
-            else:
-                users.append(u)
         result = True
         if confirm:
             for u in users:
@@ -0,0 +1,109 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+User group relation
+-------------------
+The users global groups are stored JSON encoded in the `groups` field. Each assignment is
+also stored as row in the indexed relation table `users_groups` (userid, groupid) to select
+the members of a group without scanning all users.
+
+The relation is updated after user commits if the groups field has changed and removed when
+the user is deleted. Existing databases are filled by `nive_userdb.tools.syncUserGroups`.
+
+The table is created by `nive.tools.dbStructureUpdater`.
+"""
+
+import json
+
+from nive.definitions import Structure, FieldConf, MetaTbl
+
+from nive_userdb.i18n import _
+
+
+UserGroupsTbl = "users_groups"
+
+Structure[UserGroupsTbl] = {"identity": None,
+                            "fields": (
+    FieldConf(id="userid",  datatype="number",  size=8,   default=0,   required=1, readonly=1, name=_("User ID")),
+    FieldConf(id="groupid", datatype="string",  size=50,  default="",  required=1, readonly=1, name=_("Group")),
+)}
+
+
+def SetUserGroups(db, userid, groups, cursor=None):
+    """
+    Replaces the users group assignments. The changes are not committed.
+    """
+    ph = db.placeholder
+    c = db.Execute("DELETE FROM %s WHERE userid = %s" % (UserGroupsTbl, ph), (userid,), cursor=cursor)
+    for group in set(groups or ()):
+        db.Execute("INSERT INTO %s (userid, groupid) VALUES (%s,%s)" % (UserGroupsTbl, ph, ph), (userid, group), cursor=c)
+    if cursor is None:
+        c.close()
+
+
+def RemoveUserGroups(db, userid):
+    """
+    Removes the users group assignments. The changes are not committed.
+    """
+    db.Execute("DELETE FROM %s WHERE userid = %s" % (UserGroupsTbl, db.placeholder), (userid,)).close()
+
+
+def GroupCondition(db, groups, column="meta__.id"):
+    """
+    Returns a sql condition restricting `column` to members of one of `groups` and the values
+    for the placeholders.
+    returns condition, values
+    """
+    if isinstance(groups, str):
+        groups = [groups]
+    ph = db.placeholder
+    condition = "%s IN (SELECT userid FROM %s WHERE groupid IN (%s))" % (column, UserGroupsTbl, ",".join([ph]*len(groups)))
+    return condition, list(groups)
+
+
+def LoadGroups(value):
+    """
+    Returns the groups stored in the users `groups` field as tuple
+    """
+    if not value:
+        return ()
+    if isinstance(value, str):
+        try:
+            value = json.loads(value)
+        except ValueError:
+            return ()
+    if isinstance(value, str):
+        return (value,)
+    return tuple(value)
+
+
+def SyncUserGroups(app, batch=1000):
+    """
+    Rebuilds the relation table from the users `groups` field. Users are read in batches
+    ordered by id and each batch is committed.
+    returns the number of users and assignments
+    """
+    db = app.db
+    table = app.configurationQuery.GetObjectConf("user", skipRoot=True).dbparam
+    ph = db.placeholder
+    select = """SELECT meta__.id, data__.groups FROM %s AS meta__
+                INNER JOIN %s AS data__ ON (meta__.pool_dataref = data__.id)
+                WHERE meta__.pool_type = 'user' AND meta__.id > %s ORDER BY meta__.id LIMIT %d""" % (MetaTbl, table, ph, batch)
+    users = assignments = 0
+    last = 0
+    while True:
+        records = db.Query(select, [last])
+        if not records:
+            break
+        cursor = db.connection.cursor()
+        for id, groups in records:
+            groups = LoadGroups(groups)
+            SetUserGroups(db, id, groups, cursor=cursor)
+            assignments += len(set(groups))
+        cursor.close()
+        db.Commit()
+        users += len(records)
+        last = records[-1][0]
+    return users, assignments
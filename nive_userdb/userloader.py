@@ -0,0 +1,204 @@
+# Copyright 2012, 2013 Arndt Droullier, Nive GmbH. All rights reserved.
+# Released under GPL3. See license.txt
+#
+
+__doc__ = """
+Request user loader
+-------------------
+Collects user identity lookups during a request and resolves them in batches. Views and
+templates showing many users (e.g. the author of each list row) register the identities
+first and read the users afterwards ::
+
+    loader = GetUserLoader(request, userdb)
+    loader.Add([item["pool_createdby"] for item in items])
+    ...
+    user = loader.Get(item["pool_createdby"])
+
+All pending identities are resolved with a single `Userroot.IterUserInfos()` query on the
+first `Get()`. The configured admin user is resolved without query. Users are returned as read only session users, added to `app.usercache` if
+the session user cache is enabled and memoized for the rest of the request. A single pending
+identity is looked up by `Userroot.GetUser()` including cache and events.
+
+The loader is stored in `request.environ` and shared by views and `UserDB.Principals()`.
+
+The loader also keeps an identity map of database user objects. `GetObject()` loads the
+write enabled user once per request, e.g. for `UserView.User(sessionuser=False)`. Deleted
+users are removed from the loader of the current request.
+
+`UserDB.Principals()` memoizes the principals per user and context in the loader. Changing
+the users groups removes the memoized principals.
+"""
+
+from pyramid.threadlocal import get_current_request
+
+from nive.security import AdminUser
+
+from nive_userdb.extensions.sessionuser import GetSessionUserPlan
+
+
+class UserLoader(object):
+    """
+    Request scoped user resolver. Identities added by `Add()` are loaded together on
+    the next `Get()` or `GetMany()`.
+    """
+
+    def __init__(self, app, activeOnly=1):
+        self.app = app
+        self.activeOnly = activeOnly
+        self.users = {}
+        self.objects = {}
+        # principals by (userid, user, context). see UserDB.Principals()
+        self.principals = {}
+        self.pending = []
+
+    def Add(self, idents):
+        """
+        Registers identities to be resolved with the next batch.
+        """
+        if isinstance(idents, str):
+            idents = (idents,)
+        for ident in idents:
+            if ident and not str(ident) in self.users:
+                self.pending.append(str(ident))
+
+    def Get(self, ident):
+        """
+        Returns the user for `ident` or None. Pending identities are resolved first.
+        """
+        if not ident:
+            return None
+        ident = str(ident)
+        if not ident in self.users:
+            self.Add(ident)
+            self.Load()
+        return self.users.get(ident)
+
+    def GetMany(self, idents):
+        """
+        Returns the users for `idents` as list in the same order. Unknown identities are
+        returned as None.
+        """
+        self.Add(idents)
+        self.Load()
+        return [self.users.get(str(ident)) if ident else None for ident in idents]
+
+    def GetObject(self, ident):
+        """
+        Returns the database user object for `ident` or None. The object is loaded once
+        and shared for the rest of the request.
+        """
+        if not ident:
+            return None
+        ident = str(ident)
+        if not ident in self.objects:
+            self.objects[ident] = self.app.root.LookupUser(ident=ident, activeOnly=self.activeOnly)
+        return self.objects[ident]
+
+    def Set(self, ident, user):
+        """
+        Stores an already loaded user for the rest of the request.
+        """
+        self.users[str(ident)] = user
+
+    def Invalidate(self, ident=None):
+        """
+        Removes a single user or all users, user objects and principals from the loader.
+        """
+        if ident is None:
+            self.users.clear()
+            self.objects.clear()
+            self.principals.clear()
+        else:
+            ident = str(ident)
+            self.users.pop(ident, None)
+            self.objects.pop(ident, None)
+            for key in [k for k in self.principals if k[0]==ident]:
+                del self.principals[key]
+
+    def Load(self):
+        """
+        Resolves all pending identities. The configured admin user, cached users and 
+        identities recently not found are taken from the configuration, `app.usercache`
+        and `app.usermisses`. Remaining identities are selected in one query.
+        """
+        pending, self.pending = self.pending, []
+        idents = []
+        for ident in pending:
+            if not ident in self.users and not ident in idents:
+                idents.append(ident)
+        if not idents:
+            return
+        root = self.app.root
+        if len(idents) == 1:
+            self.users[idents[0]] = root.GetUser(idents[0], activeOnly=self.activeOnly)
+            return
+        # the admin user is not stored in the database
+        admins = root.GetUserLookup().admins
+        cache = getattr(self.app, "usercache", None)
+        misses = getattr(self.app, "usermisses", None)
+        missing = []
+        for ident in idents:
+            admin = admins.get(("ident", ident))
+            if admin is not None:
+                self.users[ident] = AdminUser(*admin)
+                continue
+            if cache is not None:
+                user = cache.Get(ident)
+                if user is not None:
+                    self.users[ident] = user
+                    continue
+            if misses is not None and misses.IsMissing(ident, self.activeOnly):
+                self.users[ident] = None
+                continue
+            missing.append(ident)
+        idents = missing
+        if not idents:
+            return
+        plan = GetSessionUserPlan(self.app)
+        identityField = root.identityField
+        structure = self.app.db.structure
+        for ident in idents:
+            self.users[ident] = None
+        for record in root.IterUserInfos(idents, fields=list(plan.fields), activeOnly=self.activeOnly):
+            ident = str(record[identityField])
+            user = plan.FromRecord(ident, record, structure=structure)
+            self.users[ident] = user
+            if cache is not None:
+                cache.Add(user, ident)
+        if misses is not None:
+            for ident in idents:
+                if self.users[ident] is None:
+                    misses.Add(ident, self.activeOnly)
+
+
+def GetUserLoader(request, app):
+    """
+    Returns the user loader for the request. The loader is created on first use and
+    removed when the request is finished. Without request a new loader is returned.
+    """
+    if request is None:
+        return UserLoader(app)
+    if not hasattr(request, "environ"):
+        request.environ = dict()
+    loader = request.environ.get("nive_userdb.userloader")
+    if loader is None or loader.app is not app:
+        loader = request.environ["nive_userdb.userloader"] = UserLoader(app)
+        def remove_loader(request):
+            request.environ.pop("nive_userdb.userloader", None)
+        add_callback = getattr(request, "add_finished_callback", None)
+        if add_callback is not None:
+            add_callback(remove_loader)
+    return loader
+
+
+def InvalidateRequestUser(app, ident, request=None):
+    """
+    Removes the user from the loader of the current request if one exists.
+    """
+    request = request or get_current_request()
+    environ = getattr(request, "environ", None)
+    if not environ:
+        return
+    loader = environ.get("nive_userdb.userloader")
+    if loader is not None and loader.app is app:
+        loader.Invalidate(ident)
@@ -117,8 +117,7 @@ class tViews(__local.DefaultTestCase):
     
     def test_mails(self):
         user = User("test")
-        user.data["token"] = "123"
-        values = {"user": user, "url":"uu", "password": "12345"}
+        values = {"user": user, "url":"uu", "password": "12345", "token": "123"}
         render("nive_userdb.userview:mails/notify.pt", values)
         render("nive_userdb.userview:mails/signup.pt", values)
         render("nive_userdb.userview:mails/verifymail.pt", values)
@@ -126,6 +125,22 @@ class tViews(__local.DefaultTestCase):
         render("nive_userdb.userview:mails/resetpass.pt", values)
     
     
+    def test_requestuser(self):
+        self.root.AddUser({"name": "testuser", "email": "testuser@aaa.ccc", "password": "11111"},
+                          activate=1, generatePW=0, mail=None, groups="", currentUser=User("test"))
+        self.config.testing_securitypolicy(userid="testuser")
+        view = UserView(context=self.root, request=self.request)
+        user = view.User(sessionuser=False)
+        self.assertTrue(user.data.name == "testuser")
+        # loaded once per request
+        self.assertTrue(view.User(sessionuser=False) is user)
+        view2 = UserView(context=self.root, request=self.request)
+        self.assertTrue(view2.User(sessionuser=False) is user)
+        # removed on delete
+        self.root.DeleteUser("testuser")
+        self.assertTrue(view.User(sessionuser=False) is None)
+
+
     def test_form(self):
         view = TestView(context=self.root, request=self.request)
         form = UserForm(loadFromType="user", context=self.root, request=self.request, view=view, app=self.app)
@@ -259,13 +274,15 @@ class tViews(__local.DefaultTestCase):
 
         form = UserForm(loadFromType="user", context=self.root, request=self.request, view=view, app=self.app)
         form.Setup(subset="updatemail2")
-        self.request.GET = {"token": self.root.LookupUser(name="testuser", reloadFromDB=1).data.token}
+        # tokens are stored hashed. replace the mailed token with a known one.
+        token = self.root.GetTokenStore().Create(self.root.LookupUser(name="testuser").id, "verifymail")
+        self.request.GET = {"token": token}
         form.UpdateMailToken("action", redirectSuccess="")
         self.assertTrue(self.root.GetUser("testuser").data.email=="newuser@domain.net")
 
         form = UserForm(loadFromType="user", context=self.root, request=self.request, view=view, app=self.app)
         form.Setup(subset="updatemail2")
-        self.request.POST = {"token": self.root.LookupUser(name="testuser", reloadFromDB=1).data.token}
+        self.request.POST = {"token": token}
         self.request.GET = {}
         r, v = form.UpdateMailToken("action", redirectSuccess="")
         self.assertFalse(r)
@@ -314,7 +331,7 @@ class tViews(__local.DefaultTestCase):
         r, v = form.MailPassToken("action", redirectSuccess="", url="")
         self.assertTrue(r, v)
         u = self.root.GetUserByName("testuser")
-        self.assertTrue(u.data.token)
+        self.assertTrue(self.root.GetTokenStore().GetTokens(u.id))
 
         self.request.POST = {"email": "not a email@ net"}
         r, v = form.MailPassToken("action", redirectSuccess="")
@@ -332,14 +349,15 @@ class tViews(__local.DefaultTestCase):
         r, v = form.UpdatePassToken("action", redirectSuccess="")
         self.assertFalse(r)
 
-        testuser.data["token"] = "12345"
-        testuser.Commit(user=view.User())
-        self.request.POST = {"password": "abcde", "password-confirm": "abcde", "token": "12345"}
+        # reset tokens are only taken from the token store
+        token = self.root.GetTokenStore().Create(testuser.id, "reset")
+        self.request.POST = {"password": "abcde", "password-confirm": "abcde", "token": token}
         r, v = form.UpdatePassToken("action", redirectSuccess="")
         self.assertTrue(r, v)
 
         u = self.root.GetUserByName("testuser")
         self.assertFalse(u.data.token)
+        self.assertFalse(self.root.GetTokenStore().Lookup(token))
 
 
 
@@ -17,6 +17,7 @@ from nive.components.reform.forms import ObjectForm
 from nive_userdb.i18n import _
 from nive_userdb.i18n import translator
 from nive_userdb.app import EmailValidator, UsernameValidator, OldPwValidator
+from nive_userdb.userloader import GetUserLoader
 import collections
 
 
@@ -367,7 +368,7 @@ class UserView(BaseView):
             title = viewconf.settings.get("title","")
         form = self._loadSimpleForm(context=self.context.root)
         token = self.GetFormValue("token")
-        user = self.context.root.GetUserForToken(token)
+        user = self.context.root.GetUserForToken(token, purpose="reset")
         if user is None:
             form.Setup(subset="editpass_token2")
         else:
@@ -477,7 +478,7 @@ class UserView(BaseView):
 
         # get the receiver
         if isinstance(receiver, str):
-            user = self.context.root.GetUser(receiver)
+            user = self.UserLoader().Get(receiver)
             receiver = ((user.data.get("email"), user.meta.get("title")),)
         elif IUser.providedBy(receiver):
             receiver = ((receiver.data.get("email"), receiver.meta.get("title")),)
@@ -652,6 +653,28 @@ class UserView(BaseView):
         policy.forget(request, response=request.response)
 
 
+    def User(self, sessionuser=True):
+        """
+        Get the currently signed in user. With `sessionuser=False` the write enabled user
+        is loaded from the database once per request and shared by validators, form 
+        actions and views.
+        """
+        if sessionuser:
+            return BaseView.User(self, sessionuser)
+        ident = self.request.authenticated_userid
+        if not ident:
+            return None
+        return self.UserLoader().GetObject(ident)
+
+
+    def UserLoader(self):
+        """
+        Returns the request scoped user loader to resolve many user identities with a 
+        single query. See `nive_userdb.userloader`.
+        """
+        return GetUserLoader(self.request, self.context.app)
+
+
     def _loadSimpleForm(self, context=None):
         # form rendering settings
         # form setup
@@ -944,7 +967,7 @@ class UserForm(ObjectForm):
         if data:
             if data.find("token=")!=-1:
                 data = data.split("token=")[-1]
-            user = self.context.GetUserForToken(data, activeOnly=False)
+            user = self.context.GetUserForToken(data, activeOnly=False, purpose="activate")
             if user is not None:
                 result = True
                 user.Activate(currentUser=user)
@@ -1029,7 +1052,7 @@ class UserForm(ObjectForm):
         if data:
             if data.find("token=")!=-1:
                 data = data.split("token=")[-1]
-            user = self.context.GetUserForToken(data)
+            user = self.context.GetUserForToken(data, purpose="verifymail")
             if user:
                 mail = user.data.tempcache
                 if mail.startswith("verifymail:"):
@@ -1038,6 +1061,7 @@ class UserForm(ObjectForm):
                     user.data["tempcache"] = ""
                     user.data["token"] = ""
                     user.Commit(user=user)
+                    self.context.GetTokenStore().Remove(user.id, "verifymail")
                     msgs = [_("OK. The new email address has been activated.")]
                     result = True
         if not result:
@@ -1103,7 +1127,7 @@ class UserForm(ObjectForm):
         redirectSuccess = kw.get("redirectSuccess")
         result,data,errors = self.Validate(self.request)
         if result and data.get("token"):
-            user = self.context.root.GetUserForToken(data["token"])
+            user = self.context.root.GetUserForToken(data["token"], purpose="reset")
             if not user:
                 return result, self.Render(data, msgs=[_("The token is invalid. Please make sure it is complete.")], errors=None)
             result = user.UpdatePassword(data["password"], self.view.User())